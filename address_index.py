@@ -0,0 +1,122 @@
+'''
+A compact, read-only, memory-mapped index of address points.
+
+File layout (little endian):
+
+    header   magic, version, record count, offset of the string pool
+    records  fixed width, sorted by key hash:
+             key hash, lat, lon, key offset, label offset, key length, label length
+    strings  utf-8 normalized keys and original address labels
+
+Lookups binary search the records by hash and confirm the key in the
+string pool. Unlike `result_cache`, keys are stored: the fuzzy index is
+built from them, and an index is built once from a gazetteer rather than
+merged into, so sorted records need no empty slots. Mapping and replacing
+the file are shared with it (see `mapped_file`).
+'''
+import csv
+import hashlib
+import struct
+from typing import Iterable, Iterator, Optional, Tuple
+
+from mapped_file import MappedFile, replacing
+from normalize import normalize_address
+
+MAGIC = b'RGAI'
+VERSION = 1
+HEADER = struct.Struct('<4sIQQ')
+RECORD = struct.Struct('<QddQQHH')
+HASH = struct.Struct('<Q')
+
+
+def key_hash(key: str) -> int:
+    return HASH.unpack(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest())[0]
+
+
+def build_index(rows: Iterable[Tuple[str, float, float]], path: str) -> int:
+    '''
+    Write an index of (address, lat, lon) rows to `path`. Rows whose
+    addresses normalize to the same key keep the first one seen.
+    Returns the number of records written.
+    '''
+    entries = {}
+    for address, lat, lon in rows:
+        key = normalize_address(address)
+        if key and key not in entries:
+            entries[key] = (float(lat), float(lon), address)
+
+    records = sorted((key_hash(key), key) for key in entries)
+    strings = bytearray()
+    packed = bytearray()
+    for h, key in records:
+        lat, lon, label = entries[key]
+        key_bytes, label_bytes = key.encode('utf-8'), label.encode('utf-8')
+        key_off = len(strings)
+        strings += key_bytes
+        label_off = len(strings)
+        strings += label_bytes
+        packed += RECORD.pack(h, lat, lon, key_off, label_off, len(key_bytes), len(label_bytes))
+
+    with replacing(path) as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records), HEADER.size + len(packed)))
+        f.write(packed)
+        f.write(strings)
+
+    return len(records)
+
+
+def build_index_from_csv(csv_path: str, index_path: str, address_col='address', lat_col='lat', lon_col='lon') -> int:
+    '''Build an index from a CSV export of address points, e.g. a flattened G-NAF.'''
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        rows = ((row[address_col], row[lat_col], row[lon_col]) for row in csv.DictReader(f))
+        return build_index(rows, index_path)
+
+
+class AddressIndex(MappedFile):
+    HEADER, MAGIC, VERSION = HEADER, MAGIC, VERSION
+    KIND = 'an address index'
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.count, self.strings_offset = self.fields
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _record(self, i: int) -> tuple:
+        return RECORD.unpack_from(self.mm, HEADER.size + i * RECORD.size)
+
+    def _hash_at(self, i: int) -> int:
+        return HASH.unpack_from(self.mm, HEADER.size + i * RECORD.size)[0]
+
+    def get(self, key: str) -> Optional[Tuple[float, float, str]]:
+        '''(lat, lon, label) for a normalized key, or None.'''
+        h = key_hash(key)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._hash_at(mid) < h:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        key_bytes = key.encode('utf-8')
+        while lo < self.count:
+            record_hash, lat, lon, key_off, label_off, key_len, label_len = self._record(lo)
+            if record_hash != h:
+                break
+            start = self.strings_offset + key_off
+            if self.mm[start:start + key_len] == key_bytes:
+                return lat, lon, self._string(label_off, label_len)
+            lo += 1
+
+        return None
+
+    def lookup(self, address: str) -> Optional[Tuple[float, float, str]]:
+        return self.get(normalize_address(address))
+
+    def items(self) -> Iterator[Tuple[str, float, float, str]]:
+        '''(key, lat, lon, label) for every record, in index order.'''
+        for i in range(self.count):
+            _, lat, lon, key_off, label_off, key_len, label_len = self._record(i)
+            yield self._string(key_off, key_len), lat, lon, self._string(label_off, label_len)
@@ -1,13 +1,55 @@
 
 from contextlib import contextmanager
+import json
 import time
+import httpx
 from common import GeocodedLocation
 
+import fast_json
 from stream import GeocodeStreamerQueue, GeocoderStreamerAsync
 from mock_geocoders import make_mock_geocoder
 
 REQUEST_DURATION = 0.1
 
+# Shaped like real responses, which carry far more than the few fields we read.
+GOOGLE_REALISTIC_RESP = {
+    'results': [{
+        'address_components': [
+            {'long_name': '2', 'short_name': '2', 'types': ['street_number']},
+            {'long_name': 'Achilles Loop', 'short_name': 'Achilles Loop', 'types': ['route']},
+            {'long_name': 'Iluka', 'short_name': 'Iluka', 'types': ['locality', 'political']},
+            {'long_name': 'City of Joondalup', 'short_name': 'Joondalup', 'types': ['administrative_area_level_2', 'political']},
+            {'long_name': 'Western Australia', 'short_name': 'WA', 'types': ['administrative_area_level_1', 'political']},
+            {'long_name': 'Australia', 'short_name': 'AU', 'types': ['country', 'political']},
+            {'long_name': '6028', 'short_name': '6028', 'types': ['postal_code']},
+        ],
+        'formatted_address': '2 Achilles Loop, Iluka WA 6028, Australia',
+        'geometry': {
+            'location': {'lat': -31.7337549, 'lng': 115.728749},
+            'location_type': 'ROOFTOP',
+            'viewport': {
+                'northeast': {'lat': -31.7324059197085, 'lng': 115.7300979802915},
+                'southwest': {'lat': -31.7351038802915, 'lng': 115.7274000197085},
+            },
+        },
+        'place_id': 'ChIJ' + 'x' * 40,
+        'plus_code': {'compound_code': '7PC9+GG Iluka WA, Australia', 'global_code': '4PVQ7PC9+GG'},
+        'types': ['street_address'],
+    }],
+    'status': 'OK',
+}
+# Requests ask for maxLocations=1, so real responses carry a single candidate.
+ESRI_REALISTIC_RESP = {
+    'spatialReference': {'wkid': 4326, 'latestWkid': 4326},
+    'candidates': [{
+        'address': '2 Achilles Loop, Iluka, Western Australia, 6028',
+        'location': {'x': 115.72874704177, 'y': -31.733750976498},
+        'score': 100,
+        'attributes': {'Score': 100, 'Addr_type': 'PointAddress'},
+        'extent': {'xmin': 115.727, 'ymin': -31.734, 'xmax': 115.729, 'ymax': -31.732},
+    }],
+}
+
 def with_queue(addresses: list, rate_limit: int=2):
     Geocoder = make_mock_geocoder(request_duration=REQUEST_DURATION)
     geocoder_streamer = GeocodeStreamerQueue(rate_limit=rate_limit, Geocoder=Geocoder)
@@ -21,6 +63,23 @@ def with_async_gen(addresses: list, rate_limit: int=2):
         assert isinstance(result, GeocodedLocation)
 
 
+def bench_response_decoding(n: int = 20_000):
+    '''Decoding cost per response body: httpx's resp.json() vs fast_json.'''
+    for provider, message in [('google', GOOGLE_REALISTIC_RESP), ('esri', ESRI_REALISTIC_RESP)]:
+        resp = httpx.Response(200, content=json.dumps(message).encode('utf-8'), headers={'content-type': 'application/json'})
+        resp.read()
+
+        for label, decode in [
+            ('resp.json()', resp.json),
+            (f'fast_json ({fast_json.BACKEND})', lambda: fast_json.loads(resp.content)),
+        ]:
+            start = time.perf_counter()
+            for _ in range(n):
+                decode()
+            per_call = (time.perf_counter() - start) / n * 1e6
+            print(f'[{provider}] {label}: {per_call:.1f} us per response')
+
+
 @contextmanager
 def timeit(name=''):
     start = time.time()
@@ -45,3 +104,5 @@ if __name__ == '__main__':
         with_queue(addresses, rate_limit)
     with timeit('Async generator approach'):
         with_async_gen(addresses, rate_limit)
+
+    bench_response_decoding()
@@ -0,0 +1,191 @@
+'''
+A thread-safe, synchronous geocoding client for code that isn't async
+(Celery tasks, Spark UDFs, thread pools).
+
+Unlike `GeocodeStreamerQueue`, which builds a loop, geocoder and connection
+pool for every call, a `GeocoderClient` keeps one background event loop
+alive and every thread's calls share its geocoder, HTTP connection pool,
+rate limiter and any coordinator cache:
+
+    client = GeocoderClient.shared()
+    loc = client.geocode('1 Main St, Perth WA')
+    locs = client.geocode_many(addresses)
+    future = client.submit(address)  # concurrent.futures.Future
+
+Pass `eager=True` (or call `warmup()`) to connect and fetch tokens up
+front instead of during the first calls.
+'''
+import asyncio
+from concurrent.futures import Future
+from dataclasses import replace
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Tuple, Type
+
+import deadlines
+import lanes
+import protocols
+from common import GeocodedLocation, GeocoderError
+from normalize import normalize_address
+from strategies import robust
+from strategies.abstract import WarmupReport
+
+logger = logging.getLogger(__name__)
+
+
+class GeocoderClient:
+    '''
+    Calls may come from any number of threads at once. The background loop
+    starts on first use, and again in a forked child (e.g. a prefork Celery
+    worker), since threads don't survive a fork; the child's rate limiters
+    start empty too (see `lanes`).
+
+    Failed addresses come back as `GeocodedLocation.null_island` rather than
+    raising, as they do from the streamers. Concurrent requests for the same
+    normalized address share one lookup if they also have the same deadline,
+    timeout and lane, so a batch that runs out of time doesn't time out an
+    interactive call with it.
+    '''
+
+    def __init__(self, rate_limit: int = 2, Geocoder: Type[protocols.AsyncGeocoder] = robust.Geocoder, eager: bool = False):
+        self.Geocoder = Geocoder
+        self.rate_limit = rate_limit
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self.warmup_report: Optional[WarmupReport] = None
+        if eager:
+            self.warmup()
+
+    def _run_loop(self, loop: asyncio.AbstractEventLoop, started: threading.Event):
+        asyncio.set_event_loop(loop)
+        try:
+            self.geocoder = self.Geocoder(rate_limit=self.rate_limit)
+            self._client = self.geocoder.RequestClient()
+            self._in_flight: Dict[tuple, asyncio.Future] = {}
+        except Exception as e:
+            self._start_error = e
+            started.set()
+            loop.close()
+            return
+
+        loop.call_soon(started.set)
+        try:
+            loop.run_forever()
+        finally:
+            # Lookups still running hold rate limit slots shared with every
+            # other geocoder for their providers, so they're cancelled and
+            # run to completion rather than left on a closed loop.
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.run_until_complete(self._client.aclose())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        if self._loop is not None and self._pid == os.getpid():
+            return self._loop
+
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                started = threading.Event()
+                thread = threading.Thread(target=self._run_loop, args=(loop, started), name=f'{self.__class__.__name__}-loop', daemon=True)
+                self._start_error = None
+                thread.start()
+                started.wait()
+                if self._start_error is not None:
+                    raise self._start_error
+                self._loop, self._thread, self._pid = loop, thread, os.getpid()
+            return self._loop
+
+    async def _lookup(self, address: str, job_deadline: Optional[float], address_timeout: Optional[float]) -> GeocodedLocation:
+        try:
+            return await self.geocoder._geocode_before_deadline(address, self._client, job_deadline, address_timeout)
+        except GeocoderError:
+            return GeocodedLocation.null_island(address)
+
+    async def _geocode(self, address: str, job_deadline: Optional[float], address_timeout: Optional[float], lane: str) -> GeocodedLocation:
+        key = (normalize_address(address), job_deadline, address_timeout, lane)
+        lookup = self._in_flight.get(key)
+        if lookup is None:
+            with lanes.scope(lane):
+                lookup = self._in_flight[key] = asyncio.ensure_future(self._lookup(address, job_deadline, address_timeout))
+            lookup.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        loc = await asyncio.shield(lookup)
+        return loc if loc.address == address else replace(loc, address=address)
+
+    async def _geocode_many(self, addresses: List[str], deadline: Optional[float], address_timeout: Optional[float], lane: str) -> List[GeocodedLocation]:
+        job_deadline = deadlines.after(deadline)
+        return list(await asyncio.gather(*(self._geocode(address, job_deadline, address_timeout, lane) for address in addresses)))
+
+    def submit(self, address: str, address_timeout: Optional[float] = None, lane: str = lanes.INTERACTIVE) -> Future:
+        '''Start geocoding `address` and return a future for its result.'''
+        loop = self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(self._geocode(address, None, address_timeout, lane), loop)
+
+    def submit_many(self, addresses: List[str], deadline: Optional[float] = None, address_timeout: Optional[float] = None, lane: str = lanes.BULK) -> Future:
+        '''
+        Start geocoding a batch and return one future for the list of
+        results, in order. A whole batch costs one hop onto the loop.
+        '''
+        loop = self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(self._geocode_many(addresses, deadline, address_timeout, lane), loop)
+
+    def geocode(self, address: str, address_timeout: Optional[float] = None, lane: str = lanes.INTERACTIVE) -> GeocodedLocation:
+        return self.submit(address, address_timeout, lane).result()
+
+    def geocode_many(self, addresses: List[str], deadline: Optional[float] = None, address_timeout: Optional[float] = None, lane: str = lanes.BULK) -> List[GeocodedLocation]:
+        '''
+        `deadline` and `address_timeout` work as for `geocode_gen`; addresses
+        that run out of time come back as `GeocodedLocation.timed_out`.
+        '''
+        return self.submit_many(addresses, deadline, address_timeout, lane).result()
+
+    def warmup(self, connections: int = 2) -> WarmupReport:
+        '''
+        Start the background loop now, and open connections to and fetch
+        tokens for each provider (see `Geocoder.warmup`), rather than on
+        the first call.
+        '''
+        loop = self._ensure_started()
+        self.warmup_report = asyncio.run_coroutine_threadsafe(self.geocoder.warmup(self._client, connections), loop).result()
+        return self.warmup_report
+
+    def close(self) -> None:
+        '''
+        Stop the background loop and close its connections. Calls still in
+        progress are cancelled, so their futures raise CancelledError.
+        '''
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = self._pid = None
+        if loop is not None and thread.is_alive():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    _shared: Dict[Tuple[type, int], 'GeocoderClient'] = {}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, rate_limit: int = 2, Geocoder: Type[protocols.AsyncGeocoder] = robust.Geocoder) -> 'GeocoderClient':
+        '''
+        One client per process for each Geocoder and rate limit, so that
+        per-partition or per-task code doesn't pay for a new loop and
+        connection pool each time.
+        '''
+        with cls._shared_lock:
+            key = (Geocoder, rate_limit)
+            if key not in cls._shared:
+                cls._shared[key] = cls(rate_limit=rate_limit, Geocoder=Geocoder)
+            return cls._shared[key]
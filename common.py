@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from enum import Enum
 
 class GeocoderError(Exception): ...
 
@@ -14,12 +15,45 @@ class BadRequestError(GeocoderError): ...
 
 class ServerError(GeocoderError): ...
 
+class DeadlineExceededError(GeocoderError): ...
+
+class NotSupportedError(GeocoderError): ...
+
+class MATCH_LEVEL(str, Enum):
+    '''
+    Provider-independent precision of a geocode, best first.
+
+    Each provider maps its own notion of precision (Google `location_type`,
+    ESRI `Addr_type`) onto these levels so results can be compared.
+    '''
+    ROOFTOP = 'rooftop'
+    INTERPOLATED = 'interpolated'
+    STREET = 'street'
+    LOCALITY = 'locality'
+    APPROXIMATE = 'approximate'
+    NONE = 'none'
+
+
+# The best confidence a result at each match level can have. Providers
+# scale this down by their own score (ESRI) or partial-match flag (Google).
+MATCH_LEVEL_CONFIDENCE = {
+    MATCH_LEVEL.ROOFTOP: 1.0,
+    MATCH_LEVEL.INTERPOLATED: 0.8,
+    MATCH_LEVEL.STREET: 0.6,
+    MATCH_LEVEL.LOCALITY: 0.3,
+    MATCH_LEVEL.APPROXIMATE: 0.2,
+    MATCH_LEVEL.NONE: 0.0,
+}
+
+
 @dataclass
 class GeocodedLocation:
     address: str
     lat: float
     lon: float
     geocode_address: str
+    confidence: float = 0.0
+    match_level: MATCH_LEVEL = MATCH_LEVEL.NONE
 
     @classmethod
     def null_island(cls, address: str) -> 'GeocodedLocation':
@@ -29,3 +63,22 @@ class GeocodedLocation:
             lon=0, 
             geocode_address='Could not geocode'
         )
+
+    @classmethod
+    def from_dict(cls, values: dict) -> 'GeocodedLocation':
+        '''Inverse of `dataclasses.asdict`, e.g. for results read back from JSON.'''
+        match_level = MATCH_LEVEL(values.get('match_level', MATCH_LEVEL.NONE))
+        return cls(**{**values, 'match_level': match_level})
+
+    @classmethod
+    def timed_out(cls, address: str) -> 'GeocodedLocation':
+        return cls(
+            address=address,
+            lat=0,
+            lon=0,
+            geocode_address='Timed out'
+        )
+
+    @property
+    def is_null_island(self) -> bool:
+        return self.lat == 0 and self.lon == 0
@@ -0,0 +1,210 @@
+'''
+Rate limits and a result cache shared by every process using the same
+backend, so a fleet of workers stays within one provider quota.
+
+The backend interface is a small subset of Redis (`get`, `set` with `ex`,
+and an atomic token reservation), with three implementations:
+
+- `InProcessBackend`: a dict, for a single process and for tests.
+- `SQLiteBackend`: a file, for several processes on one host.
+- `RedisBackend`: wraps a redis-py compatible client, for several hosts.
+
+Turn it on for every geocoder by setting the class attribute:
+
+    abstract.Geocoder.coordinator = Coordinator(
+        SQLiteBackend('/var/run/robust_geocoder.db'),
+        rates={'google': 50, 'esri': 20},
+        cache_ttl=30 * 24 * 3600,
+    )
+'''
+import asyncio
+from dataclasses import asdict, replace
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Protocol
+
+from common import GeocodedLocation
+from normalize import normalize_address
+
+
+class Backend(Protocol):
+    # Backends that block on I/O are called from a worker thread.
+    blocking: bool
+    def get(self, key: str) -> Optional[bytes]: ...
+    def set(self, key: str, value: bytes, ex: Optional[int] = None) -> None: ...
+    def reserve_token(self, key: str, rate: float, burst: int) -> float: ...
+
+
+def _gcra(tat: Optional[float], now: float, rate: float, burst: int):
+    '''
+    Reserve the next request slot of a `rate`-per-second bucket holding up
+    to `burst` tokens (the generic cell rate algorithm). Returns the new
+    theoretical arrival time to store and how long the caller must wait.
+    '''
+    interval = 1 / rate
+    new_tat = max(tat or now, now) + interval
+    wait = max(0.0, new_tat - now - burst * interval)
+    return new_tat, wait
+
+
+class InProcessBackend:
+    blocking = False
+
+    def __init__(self):
+        self._data: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value, expires_at = self._data.get(key, (None, None))
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key: str, value: bytes, ex: Optional[int] = None) -> None:
+        with self._lock:
+            self._data[key] = (value, None if ex is None else time.time() + ex)
+
+    def reserve_token(self, key: str, rate: float, burst: int) -> float:
+        with self._lock:
+            now = time.time()
+            tat, _ = self._data.get(key, (None, None))
+            new_tat, wait = _gcra(tat, now, rate, burst)
+            self._data[key] = (new_tat, None)
+            return wait
+
+
+class SQLiteBackend:
+    '''
+    Shares state between processes through a SQLite file. Each thread gets
+    its own connection; token reservations are serialized with
+    BEGIN IMMEDIATE so they are atomic across processes.
+    '''
+    blocking = True
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB, expires_at REAL)')
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self._connection().execute(
+            'SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (key, time.time()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: bytes, ex: Optional[int] = None) -> None:
+        self._connection().execute(
+            'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, value, None if ex is None else time.time() + ex),
+        )
+
+    def reserve_token(self, key: str, rate: float, burst: int) -> float:
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+            new_tat, wait = _gcra(float(row[0]) if row else None, time.time(), rate, burst)
+            conn.execute('INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, NULL)', (key, new_tat))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class RedisBackend:
+    '''
+    Wraps a redis-py compatible client (`redis.Redis(...)`). The token
+    reservation runs as a Lua script using the server's clock, so hosts
+    with skewed clocks still share one bucket.
+    '''
+    blocking = True
+
+    RESERVE_TOKEN = '''
+        local t = redis.call('TIME')
+        local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+        local interval = 1 / tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+        local new_tat = math.max(tat, now) + interval
+        redis.call('SET', KEYS[1], tostring(new_tat), 'EX', math.ceil(new_tat - now) + 60)
+        return tostring(math.max(0, new_tat - now - burst * interval))
+    '''
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes, ex: Optional[int] = None) -> None:
+        self.client.set(key, value, ex=ex)
+
+    def reserve_token(self, key: str, rate: float, burst: int) -> float:
+        return float(self.client.eval(self.RESERVE_TOKEN, 1, key, rate, burst))
+
+
+class Coordinator:
+    '''
+    Fleet-wide request pacing and result caching for geocoders.
+
+    `rates` are requests per second per provider (providers without one
+    aren't paced); `burst` is how many requests may go at once after a
+    quiet spell. Results are cached per provider and normalized address for
+    `cache_ttl` seconds (None: forever), or not at all if `cache` is False.
+    '''
+
+    def __init__(self, backend: Backend, rates: Optional[Dict[str, float]] = None, burst: int = 1, cache: bool = True, cache_ttl: Optional[int] = None, namespace: str = 'robust_geocoder'):
+        self.backend = backend
+        self.rates = rates or {}
+        self.burst = burst
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        self.namespace = namespace
+
+    async def _run(self, fn, *args):
+        if self.backend.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    def _cache_key(self, provider: str, address: str, key: Optional[str] = None) -> str:
+        return f'{self.namespace}:result:{provider}:{key or normalize_address(address)}'
+
+    async def throttle(self, provider: Optional[str]) -> None:
+        '''Wait for this process's turn in the provider's shared rate limit.'''
+        rate = self.rates.get(provider)
+        if not rate:
+            return
+        wait = await self._run(self.backend.reserve_token, f'{self.namespace}:rate:{provider}', rate, self.burst)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def get_cached(self, provider: Optional[str], address: str, key: Optional[str] = None) -> Optional[GeocodedLocation]:
+        '''`key` overrides the normalized address as the cache key.'''
+        if not (self.cache and provider):
+            return None
+        value = await self._run(self.backend.get, self._cache_key(provider, address, key))
+        if value is None:
+            return None
+        return replace(GeocodedLocation.from_dict(json.loads(value)), address=address)
+
+    async def store(self, provider: Optional[str], loc: GeocodedLocation, key: Optional[str] = None) -> None:
+        if not (self.cache and provider) or loc.is_null_island:
+            return
+        value = json.dumps(asdict(loc)).encode('utf-8')
+        await self._run(self.backend.set, self._cache_key(provider, loc.address, key), value, self.cache_ttl)
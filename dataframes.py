@@ -0,0 +1,106 @@
+'''
+Geocoding pandas and Spark data a partition at a time.
+
+Instead of a Python call, a `GeocodedLocation` and a row append per row,
+a column of addresses is factorized, each unique address is geocoded once
+through a shared `GeocoderClient`, and the result columns are built as
+arrays and scattered back to the original rows:
+
+    frame = geocode_frame(df['address'])  # indexed like df
+
+With Spark, `partition_geocoder` gives a `mapInPandas` function:
+
+    df.mapInPandas(partition_geocoder('address'), schema=f'id long, address string, {RESULT_DDL}')
+
+pandas (and pyarrow, for Arrow input) are optional dependencies.
+'''
+from typing import Iterator, Optional, Type
+
+import lanes
+import protocols
+from client import GeocoderClient
+from common import MATCH_LEVEL
+from strategies import robust
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:  # optional dependency
+    np = pd = None
+
+try:
+    import pyarrow as pa
+except ImportError:  # optional dependency
+    pa = None
+
+COLUMNS = ['lat', 'lon', 'geocode_address', 'confidence', 'match_level']
+# Spark DDL for the columns `partition_geocoder` appends.
+RESULT_DDL = 'lat double, lon double, geocode_address string, confidence double, match_level string'
+
+_MATCH_LEVELS = [level.value for level in MATCH_LEVEL]
+
+
+def _require_pandas():
+    if pd is None:
+        raise ImportError('dataframes needs pandas: pip install pandas')
+
+
+def _as_series(addresses) -> 'pd.Series':
+    if pa is not None and isinstance(addresses, (pa.Array, pa.ChunkedArray)):
+        return addresses.to_pandas()
+    if isinstance(addresses, pd.Series):
+        return addresses
+    return pd.Series(addresses)
+
+
+def geocode_frame(addresses, client: Optional[GeocoderClient] = None, deadline: Optional[float] = None, address_timeout: Optional[float] = None, lane: str = lanes.BULK) -> 'pd.DataFrame':
+    '''
+    Geocode a pandas Series (or Arrow array, or list) of addresses and return
+    a DataFrame of `COLUMNS` with the same index. Repeated addresses are
+    geocoded once; missing ones (None/NaN) get NaN coordinates and no
+    match level. `client` defaults to the process's shared client.
+    '''
+    _require_pandas()
+    addresses = _as_series(addresses)
+    codes, uniques = pd.factorize(addresses)  # missing addresses get code -1
+
+    client = client or GeocoderClient.shared()
+    results = client.geocode_many(list(uniques), deadline, address_timeout, lane) if len(uniques) else []
+
+    # The extra trailing slot is what code -1 picks up.
+    n = len(results) + 1
+    lat = np.fromiter((loc.lat for loc in results), dtype=float, count=n - 1)
+    lon = np.fromiter((loc.lon for loc in results), dtype=float, count=n - 1)
+    confidence = np.fromiter((loc.confidence for loc in results), dtype=float, count=n - 1)
+    level_codes = np.fromiter((_MATCH_LEVELS.index(loc.match_level.value) for loc in results), dtype=np.int8, count=n - 1)
+    geocode_address = np.empty(n, dtype=object)
+    geocode_address[:-1] = [loc.geocode_address for loc in results]
+
+    return pd.DataFrame(
+        {
+            'lat': np.append(lat, np.nan)[codes],
+            'lon': np.append(lon, np.nan)[codes],
+            'geocode_address': geocode_address[codes],
+            'confidence': np.append(confidence, np.nan)[codes],
+            'match_level': pd.Categorical.from_codes(np.append(level_codes, -1)[codes], categories=_MATCH_LEVELS),
+        },
+        index=addresses.index,
+    )
+
+
+def partition_geocoder(column: str = 'address', rate_limit: int = 2, Geocoder: Type[protocols.AsyncGeocoder] = robust.Geocoder, **geocode_kwargs):
+    '''
+    A `mapInPandas`-style function: takes an iterator of DataFrames and
+    yields each with `COLUMNS` appended, geocoding `column`. Every partition
+    in an executor process shares one `GeocoderClient`. Extra keyword
+    arguments go to `geocode_frame`.
+    '''
+    def geocode_partition(batches: Iterator['pd.DataFrame']) -> Iterator['pd.DataFrame']:
+        _require_pandas()
+        client = GeocoderClient.shared(rate_limit=rate_limit, Geocoder=Geocoder)
+        for batch in batches:
+            results = geocode_frame(batch[column], client, **geocode_kwargs)
+            results['match_level'] = results['match_level'].astype(object)  # Arrow/Spark want plain strings
+            yield pd.concat([batch, results], axis=1)
+
+    return geocode_partition
@@ -0,0 +1,57 @@
+'''
+Deadlines that follow an address down the call stack.
+
+A deadline is an absolute `time.monotonic()` value held in a context
+variable, so it is inherited by every task and call made while geocoding
+one address: the robust fallback chain, each provider, their retries and
+the HTTP requests themselves all see how much time is left.
+'''
+from contextlib import contextmanager
+from contextvars import ContextVar
+import time
+from typing import Optional
+
+_deadline: ContextVar[Optional[float]] = ContextVar('deadline', default=None)
+
+
+def after(seconds: Optional[float]) -> Optional[float]:
+    '''The deadline `seconds` from now, or None for no deadline.'''
+    return None if seconds is None else time.monotonic() + seconds
+
+
+def current() -> Optional[float]:
+    return _deadline.get()
+
+
+def remaining() -> Optional[float]:
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def timeout(limit: Optional[float] = None) -> Optional[float]:
+    '''The smaller of `limit` and the time remaining; None if neither is set.'''
+    left = remaining()
+    if left is None:
+        return limit
+    left = max(left, 0)
+    return left if limit is None else min(left, limit)
+
+
+@contextmanager
+def scope(at: Optional[float]):
+    '''Apply deadline `at` within the block. Deadlines only ever tighten.'''
+    outer = _deadline.get()
+    if at is None or (outer is not None and outer <= at):
+        yield
+        return
+
+    token = _deadline.set(at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
@@ -0,0 +1,123 @@
+'''
+Incremental geocoding of recurring datasets.
+
+Each run's results are written as JSON lines with a fingerprint of the
+normalized address and when it was geocoded. The next run reuses those
+results and only geocodes addresses that are new, changed, previously
+failed or older than a TTL:
+
+    streamer = GeocodeStreamerQueue()
+    for loc in streamer.geocode_delta_gen(addresses, previous='yesterday.jsonl', output='today.jsonl', ttl=90 * 86400):
+        ...
+'''
+from dataclasses import asdict, dataclass, replace
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, Generator, Iterable, List, Mapping, Optional, Union
+
+from common import GeocodedLocation
+from normalize import normalize_address
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PreviousResult:
+    loc: GeocodedLocation
+    geocoded_at: Optional[float] = None  # unix time; None if unknown
+
+
+Previous = Union[str, os.PathLike, Mapping[str, PreviousResult], Iterable[GeocodedLocation]]
+
+
+def fingerprint(address: str) -> str:
+    return hashlib.blake2b(normalize_address(address).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def read_results(path: Union[str, os.PathLike]) -> Dict[str, PreviousResult]:
+    previous = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            geocoded_at = record.pop('geocoded_at', None)
+            record_fingerprint = record.pop('fingerprint', None) or fingerprint(record['address'])
+            previous[record_fingerprint] = PreviousResult(GeocodedLocation.from_dict(record), geocoded_at)
+    return previous
+
+
+def _load_previous(previous: Optional[Previous]) -> Mapping[str, PreviousResult]:
+    if previous is None:
+        return {}
+    if isinstance(previous, (str, os.PathLike)):
+        return read_results(previous) if os.path.exists(previous) else {}
+    if isinstance(previous, Mapping):
+        return previous
+    return {fingerprint(loc.address): PreviousResult(loc) for loc in previous}
+
+
+def _is_reusable(prev: Optional[PreviousResult], ttl: Optional[float], now: float) -> bool:
+    if prev is None or prev.loc.is_null_island:
+        return False
+    if ttl is None:
+        return True
+    return prev.geocoded_at is not None and now - prev.geocoded_at <= ttl
+
+
+def geocode_delta_gen(streamer, addresses: List[str], previous: Optional[Previous] = None, ttl: Optional[float] = None, output: Optional[Union[str, os.PathLike]] = None, **geocode_kwargs) -> Generator[GeocodedLocation, None, None]:
+    '''
+    Yield a result for every address, in order, geocoding only those without
+    a reusable previous result (missing, null_island or older than `ttl`
+    seconds). If `output` is given, the merged results are written there
+    for the next run, replacing it only once every address has been
+    yielded, so `output` may also be `previous`. Extra keyword arguments go
+    to `streamer.geocode_gen`.
+    '''
+    now = time.time()
+    previous = _load_previous(previous)
+    fingerprints = [fingerprint(address) for address in addresses]
+
+    to_geocode = {}
+    for address, address_fingerprint in zip(addresses, fingerprints):
+        if not _is_reusable(previous.get(address_fingerprint), ttl, now):
+            to_geocode.setdefault(address_fingerprint, address)
+
+    logger.info(f'[delta]: Reusing {len(addresses) - len(to_geocode)} results, geocoding {len(to_geocode)} addresses')
+    fresh_results = streamer.geocode_gen(list(to_geocode.values()), in_order=True, **geocode_kwargs)
+    fresh = {}
+
+    tmp_output = f'{os.fspath(output)}.tmp' if output else None
+    out = open(tmp_output, 'w', encoding='utf-8') if output else None
+    finished = False
+    try:
+        for address, address_fingerprint in zip(addresses, fingerprints):
+            if address_fingerprint in to_geocode:
+                # Fresh results arrive in to_geocode order, which is the
+                # order each fingerprint is first needed here.
+                while address_fingerprint not in fresh:
+                    loc = next(fresh_results)
+                    fresh[fingerprint(loc.address)] = loc
+                loc, geocoded_at = fresh[address_fingerprint], now
+            else:
+                prev = previous[address_fingerprint]
+                loc, geocoded_at = prev.loc, prev.geocoded_at
+
+            if loc.address != address:
+                loc = replace(loc, address=address)
+            if out:
+                record = {**asdict(loc), 'fingerprint': address_fingerprint, 'geocoded_at': geocoded_at}
+                out.write(json.dumps(record) + '\n')
+            yield loc
+        finished = True
+    finally:
+        fresh_results.close()
+        if out:
+            out.close()
+            if finished:
+                os.replace(tmp_output, output)
+            else:
+                os.remove(tmp_output)
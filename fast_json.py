@@ -0,0 +1,25 @@
+'''
+JSON decoding for provider responses.
+
+Uses orjson when it is installed and the standard library otherwise. Both
+decode straight from the response bytes, skipping the charset detection and
+str copy that `httpx.Response.json()` does first.
+'''
+import json
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+BACKEND = 'orjson' if orjson else 'json'
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, and both are
+# ValueErrors, as are the UnicodeDecodeErrors json.loads raises on bad bytes.
+DecodeError = ValueError
+
+
+def loads(content: bytes):
+    if orjson:
+        return orjson.loads(content)
+    return json.loads(content)
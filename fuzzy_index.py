@@ -0,0 +1,160 @@
+'''
+Approximate matching of addresses against a local corpus.
+
+Candidates come from trigram inverted lists (how many trigrams a corpus
+key shares with the query) and the best of them are verified with a
+bounded edit distance, so a typo such as "ACHILLIES LOOP" still finds
+"ACHILLES LOOP" without comparing the query against every key.
+'''
+from array import array
+from collections import Counter, defaultdict
+import heapq
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from normalize import normalize_address
+
+
+class SETTINGS:
+    k = 5
+    # Overlap-ranked candidates verified per result wanted.
+    candidates_per_result = 10
+    # Trigrams in more than this fraction of the corpus (e.g. the state or a
+    # big suburb) say little about which key matches, and are skipped.
+    max_posting_fraction = 0.2
+    budget_ms = 20.0
+    # Share of the budget that merging posting lists may use, leaving the
+    # rest for verifying candidates, and how many ids are merged between
+    # checks of the clock.
+    merge_budget_fraction = 0.5
+    merge_chunk = 20000
+
+
+def trigrams(text: str) -> List[str]:
+    padded = f'  {text} '
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+def bounded_edit_distance(a: str, b: str, bound: int) -> Optional[int]:
+    '''
+    Levenshtein distance between a and b, or None if it exceeds bound.
+    Only the diagonal band of width 2 * bound + 1 is computed.
+    '''
+    if abs(len(a) - len(b)) > bound:
+        return None
+    if len(a) > len(b):
+        a, b = b, a
+
+    over = bound + 1
+    previous = [i if i <= bound else over for i in range(len(a) + 1)]
+    for j in range(1, len(b) + 1):
+        cb = b[j - 1]
+        lo, hi = max(1, j - bound), min(len(a), j + bound)
+        current = [over] * (len(a) + 1)
+        current[0] = j if j <= bound else over
+        row_min = current[0]
+        for i in range(lo, hi + 1):
+            cost = previous[i - 1] + (a[i - 1] != cb)
+            if previous[i] + 1 < cost:
+                cost = previous[i] + 1
+            if current[i - 1] + 1 < cost:
+                cost = current[i - 1] + 1
+            current[i] = cost
+            if cost < row_min:
+                row_min = cost
+        if row_min > bound:
+            return None
+        previous = current
+
+    return previous[-1] if previous[-1] <= bound else None
+
+
+def similarity(a: str, b: str, distance: int) -> float:
+    return 1 - distance / max(len(a), len(b), 1)
+
+
+class FuzzyIndex:
+    '''
+    Trigram index over normalized keys. Results are (key id, score) pairs,
+    best first, where score is 1 - edits / length.
+    '''
+
+    def __init__(self, keys: Iterable[str]):
+        self.keys: List[str] = list(keys)
+        postings = defaultdict(lambda: array('I'))
+        for key_id, key in enumerate(self.keys):
+            for gram in set(trigrams(key)):
+                postings[gram].append(key_id)
+        self.postings: Dict[str, array] = dict(postings)
+        self.max_posting = max(1, int(len(self.keys) * SETTINGS.max_posting_fraction))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _query_postings(self, key: str, postings: Dict[str, Optional[array]]) -> List[array]:
+        '''
+        The posting lists of the query's trigrams that are in the corpus,
+        rarest (most telling) first. `postings` is the corpus's, or those
+        already looked up for a batch.
+        '''
+        found = sorted((len(posting), gram, posting) for gram, posting in ((gram, postings.get(gram)) for gram in set(trigrams(key))) if posting)
+        selective = [posting for size, _, posting in found if size <= self.max_posting]
+        return selective or [posting for _, _, posting in found]
+
+    def _overlaps(self, postings: List[array], deadline: float) -> Counter:
+        '''
+        How many of the query's trigrams each key shares. Merging stops at
+        `deadline`; since the rarest trigrams go first, what has been
+        counted by then is the most selective part.
+        '''
+        overlaps = Counter()
+        for posting in postings:
+            for start in range(0, len(posting), SETTINGS.merge_chunk):
+                overlaps.update(posting[start:start + SETTINGS.merge_chunk])
+                if time.perf_counter() > deadline:
+                    return overlaps
+        return overlaps
+
+    def _verify(self, key: str, overlaps: Counter, k: int, max_edits: Optional[int], deadline: float) -> List[Tuple[int, float]]:
+        bound = max_edits if max_edits is not None else max(2, len(key) // 8)
+        found = []
+        # Ties broken by key id, so results don't depend on hash order.
+        candidates = heapq.nsmallest(k * SETTINGS.candidates_per_result, overlaps.items(), key=lambda item: (-item[1], item[0]))
+        for key_id, _ in candidates:
+            candidate = self.keys[key_id]
+            distance = bounded_edit_distance(key, candidate, bound)
+            if distance is not None:
+                found.append((key_id, round(similarity(key, candidate, distance), 3)))
+                if distance == 0:
+                    break
+            if time.perf_counter() > deadline:
+                break
+
+        found.sort(key=lambda result: (-result[1], result[0]))
+        return found[:k]
+
+    def query(self, address: str, k: int = SETTINGS.k, max_edits: Optional[int] = None, budget_ms: float = SETTINGS.budget_ms) -> List[Tuple[int, float]]:
+        '''
+        The `k` best matches for `address`, within about `budget_ms`
+        (candidate generation and verification both stop when it runs out).
+        '''
+        return self._query_key(normalize_address(address), self.postings, k, max_edits, budget_ms)
+
+    def _query_key(self, key: str, postings: Dict[str, Optional[array]], k: int, max_edits: Optional[int], budget_ms: float) -> List[Tuple[int, float]]:
+        started = time.perf_counter()
+        overlaps = self._overlaps(self._query_postings(key, postings), started + budget_ms * SETTINGS.merge_budget_fraction / 1000)
+        return self._verify(key, overlaps, k, max_edits, started + budget_ms / 1000)
+
+    def query_many(self, addresses: Iterable[str], k: int = SETTINGS.k, max_edits: Optional[int] = None, budget_ms: float = SETTINGS.budget_ms) -> List[List[Tuple[int, float]]]:
+        '''
+        `query` for a batch, in order. Repeated addresses (after
+        normalization) are matched once and each distinct trigram in the
+        batch is looked up once; `budget_ms` is per distinct address.
+        '''
+        keys = [normalize_address(address) for address in addresses]
+        unique = list(dict.fromkeys(keys))
+        grams = set().union(*(trigrams(key) for key in unique))
+        postings = {gram: self.postings.get(gram) for gram in grams}
+
+        results = {key: self._query_key(key, postings, k, max_edits, budget_ms) for key in unique}
+        return [results[key] for key in keys]
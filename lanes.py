@@ -0,0 +1,290 @@
+'''
+Priority lanes for a provider's concurrency budget.
+
+Every request takes a slot from its provider's `PriorityLimiter` in the lane
+of whatever it is working for (a context variable, inherited by tasks).
+When a slot frees up it goes to the waiting lane that has had the least
+service for its weight, so an interactive lookup arriving behind a 100k
+bulk backlog is served next, and bulk work soaks up whatever is left.
+
+Limiters are shared per provider across the process (and across the event
+loops of concurrent streamers), so a quota is split between all callers.
+Slots are tracked per event loop, and whatever a loop held or was waiting
+for is taken back once it has closed. A forked child starts with every
+shared limiter empty, since the threads and loops using them stay behind.
+'''
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+
+class SETTINGS:
+    # Share of slots each lane gets while every lane has work waiting.
+    weights = {INTERACTIVE: 8, BULK: 1}
+    default_weight = 1
+
+
+_lane: ContextVar[str] = ContextVar('lane', default=INTERACTIVE)
+
+
+def current() -> str:
+    return _lane.get()
+
+
+@contextmanager
+def scope(lane: str):
+    '''Tasks created and requests made within the block use `lane`.'''
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+@dataclass
+class LaneStats:
+    waiting: int = 0
+    granted: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    @property
+    def mean_wait(self) -> float:
+        return self.total_wait / self.granted if self.granted else 0.0
+
+
+class PriorityLimiter:
+    '''
+    A counting semaphore with weighted fair queueing between lanes. It is
+    thread safe and not tied to an event loop: waiters are woken on their
+    own loop.
+    '''
+
+    def __init__(self, capacity: int, weights: Optional[Dict[str, float]] = None):
+        self.capacity = capacity
+        self.weights = dict(SETTINGS.weights if weights is None else weights)
+        self._available = capacity
+        self._lock = threading.Lock()
+        self._waiters: Dict[str, deque] = {}
+        self._virtual_time: Dict[str, float] = {}
+        self._now = 0.0  # virtual time of the last grant
+        self._stats: Dict[str, LaneStats] = {}
+        self._held: Dict[asyncio.AbstractEventLoop, int] = {}  # slots held per loop
+
+    def _lane_stats(self, lane: str) -> LaneStats:
+        if lane not in self._stats:
+            self._stats[lane] = LaneStats()
+            self._waiters[lane] = deque()
+            self._virtual_time[lane] = 0.0
+        return self._stats[lane]
+
+    def _record_grant(self, lane: str, enqueued_at: float) -> None:
+        stats = self._stats[lane]
+        wait = time.monotonic() - enqueued_at
+        stats.granted += 1
+        stats.total_wait += wait
+        stats.max_wait = max(stats.max_wait, wait)
+        self._now = self._virtual_time[lane]
+        self._virtual_time[lane] += 1 / self.weights.get(lane, SETTINGS.default_weight)
+
+    def _next_lane(self) -> Optional[str]:
+        waiting = [lane for lane, waiters in self._waiters.items() if waiters]
+        if not waiting:
+            return None
+        return min(waiting, key=lambda lane: (self._virtual_time[lane], -self.weights.get(lane, SETTINGS.default_weight)))
+
+    def _hold(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._available -= 1
+        self._held[loop] = self._held.get(loop, 0) + 1
+
+    def _unhold(self, loop: Optional[asyncio.AbstractEventLoop]) -> None:
+        self._available += 1
+        held = self._held.get(loop, 0)
+        if held > 1:
+            self._held[loop] = held - 1
+        else:
+            self._held.pop(loop, None)
+
+    def _reclaim(self) -> None:
+        # Slots held by tasks of a loop that has closed are never released.
+        for loop in [loop for loop in self._held if loop.is_closed()]:
+            held = self._held.pop(loop)
+            logger.warning(f'Reclaiming {held} slots held by a closed event loop')
+            self._available += held
+
+    def _grant_waiters(self) -> List[asyncio.Future]:
+        '''Hand free slots to waiters, best lane first. Returns the futures to wake.'''
+        granted = []
+        while self._available > 0:
+            lane = self._next_lane()
+            if lane is None:
+                break
+            fut, enqueued_at = self._waiters[lane].popleft()
+            self._stats[lane].waiting -= 1
+            if fut.get_loop().is_closed():
+                continue  # nobody is left to wait for it
+            self._hold(fut.get_loop())
+            self._record_grant(lane, enqueued_at)
+            granted.append(fut)
+        return granted
+
+    def _wake_granted(self, granted: List[asyncio.Future]) -> None:
+        for fut in granted:
+            try:
+                fut.get_loop().call_soon_threadsafe(self._wake, fut)
+            except RuntimeError:  # its loop closed since it was granted
+                with self._lock:
+                    self._unhold(fut.get_loop())
+                    more = self._grant_waiters()
+                self._wake_granted(more)
+
+    def _wake(self, fut: asyncio.Future) -> None:
+        # Runs on the waiter's loop. If it gave up in the meantime, pass the slot on.
+        if fut.cancelled():
+            self.release()
+        elif not fut.done():
+            fut.set_result(None)
+
+    async def acquire(self, lane: Optional[str] = None) -> None:
+        lane = lane or current()
+        enqueued_at = time.monotonic()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            stats = self._lane_stats(lane)
+            if self._available > 0 and self._next_lane() is None:
+                self._hold(loop)
+                self._record_grant(lane, enqueued_at)
+                return
+
+            if not self._waiters[lane]:
+                # A lane that was idle doesn't get credit for the time it was idle.
+                self._virtual_time[lane] = max(self._virtual_time[lane], self._now)
+            fut = loop.create_future()
+            waiter = (fut, enqueued_at)
+            self._waiters[lane].append(waiter)
+            stats.waiting += 1
+
+            self._reclaim()
+            woken = self._grant_waiters()
+        self._wake_granted(woken)
+
+        try:
+            await fut
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters[lane].remove(waiter)
+                    stats.waiting -= 1
+                    granted = False
+                except ValueError:
+                    granted = True
+            if granted and fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        '''Give back a slot. Call it from the event loop that acquired the slot.'''
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        with self._lock:
+            self._unhold(loop)
+            self._reclaim()
+            granted = self._grant_waiters()
+        self._wake_granted(granted)
+
+    def resize(self, capacity: int) -> None:
+        with self._lock:
+            self._available += capacity - self.capacity
+            self.capacity = capacity
+            # Hand any new slots to whoever is already waiting.
+            granted = self._grant_waiters()
+        self._wake_granted(granted)
+
+    def _after_fork(self) -> None:
+        # In a forked child, only the forking thread is left: the lock may be
+        # held by a thread that no longer exists, and no other loop will ever
+        # give its slots back or wait for one.
+        self._lock = threading.Lock()
+        self._available = self.capacity
+        self._held.clear()
+        for lane, waiters in self._waiters.items():
+            waiters.clear()
+            self._stats[lane].waiting = 0
+
+    def stats(self) -> Dict[str, LaneStats]:
+        with self._lock:
+            return {lane: LaneStats(**vars(stats)) for lane, stats in self._stats.items()}
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+_limiters: Dict[str, PriorityLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def _reset_after_fork() -> None:
+    global _limiters_lock
+    _limiters_lock = threading.Lock()
+    for limiter in _limiters.values():
+        limiter._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):  # not on Windows
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def shared_limiter(provider: Optional[str], capacity: int) -> PriorityLimiter:
+    '''
+    The process-wide limiter for `provider`, with at least `capacity` slots.
+    An existing limiter grows to `capacity` but never shrinks, so building a
+    geocoder with a small limit doesn't throttle streams already running;
+    use `configure` to lower it.
+    '''
+    if provider is None:
+        return PriorityLimiter(capacity)
+
+    with _limiters_lock:
+        limiter = _limiters.get(provider)
+        if limiter is None:
+            return _limiters.setdefault(provider, PriorityLimiter(capacity))
+    if capacity > limiter.capacity:
+        logger.info(f'[{provider}]: Growing shared limiter from {limiter.capacity} to {capacity}')
+        limiter.resize(capacity)
+    return limiter
+
+
+def configure(provider: str, capacity: int) -> PriorityLimiter:
+    '''Set the concurrency `provider` is allowed across the whole process.'''
+    with _limiters_lock:
+        limiter = _limiters.get(provider)
+        if limiter is None:
+            limiter = _limiters[provider] = PriorityLimiter(capacity)
+            return limiter
+    logger.info(f'[{provider}]: Resizing shared limiter from {limiter.capacity} to {capacity}')
+    limiter.resize(capacity)
+    return limiter
+
+
+def stats() -> Dict[str, Dict[str, LaneStats]]:
+    '''Per provider, per lane queue depth and wait times.'''
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {provider: limiter.stats() for provider, limiter in limiters.items()}
@@ -0,0 +1,70 @@
+'''
+What the read-only, memory-mapped files (`address_index`, `result_cache`)
+have in common: a header that starts with a magic number and version, a
+pool of utf-8 strings addressed by (offset, length), and being replaced
+whole rather than written in place.
+
+Opening one costs nothing and every process that opens the same file
+shares its pages through the OS page cache. Files are written to a
+temporary file beside the target and renamed over it, so readers never
+see a partly written file and keep their old mapping until they reopen.
+'''
+from contextlib import contextmanager
+import mmap
+import os
+import struct
+import tempfile
+from typing import BinaryIO, Iterator, Tuple
+
+
+def file_id(stat: os.stat_result) -> Tuple[int, int, int]:
+    '''Changes when the file at a path is replaced or rewritten.'''
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+@contextmanager
+def replacing(path: str) -> Iterator[BinaryIO]:
+    '''
+    A new, empty file to write `path`'s replacement to. It takes `path`'s
+    place when the block finishes, and is removed if the block raises.
+    Concurrent writers each get their own file; the last to finish wins.
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w+b') as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class MappedFile:
+    '''
+    A read-only mapping of a file laid out as `HEADER` (magic, version, then
+    the subclass's fields, in `fields`), ..., string pool. Subclasses set
+    `strings_offset` from their fields.
+    '''
+    HEADER: struct.Struct
+    MAGIC: bytes
+    VERSION: int
+    KIND = 'mapped file'  # for errors
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.file_id = file_id(os.fstat(f.fileno()))
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, *self.fields = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.mm.close()
+            raise ValueError(f'{path} is not {self.KIND} (version {self.VERSION})')
+        self.strings_offset = 0
+
+    def _string(self, offset: int, length: int) -> str:
+        start = self.strings_offset + offset
+        return self.mm[start:start + length].decode('utf-8')
+
+    def close(self) -> None:
+        self.mm.close()
@@ -2,6 +2,7 @@
 # can set it higher (realistic is 0.1 or 0.2) for 
 # benchmarking performance.
 import asyncio
+from collections import Counter
 import json
 from typing import Type
 import httpx
@@ -12,15 +13,32 @@ import protocols
 
 REQUEST_DURATION = 0.05
 
+# Number of requests the mock transports have served, keyed by URL.
+REQUEST_COUNTS = Counter()
+# Status codes to fail requests with instead of responding, keyed by URL.
+STATUS_CODES = {}
+# Request durations that differ from the mock's own, keyed by URL.
+REQUEST_DURATIONS = {}
+
 ESRI_TOKEN_RESP_MSG =  {'access_token': '[[fake_token]]', 'expires_in': 300}
 ESRI_GEOCODE_RESP_MSG = {
     'candidates': [{
         'address': 'Mocked Geocoded Address in ESRI Response', 
         'location': {'x': 115.72874704177, 'y': -31.733750976498}, 
+        'score': 100,
+        'attributes': {'Score': 100, 'Addr_type': 'PointAddress'},
 }]}
+ESRI_REVERSE_RESP_MSG = {
+    'address': {
+        'Match_addr': 'Mocked Reverse Geocoded Address in ESRI Response',
+        'LongLabel': 'Mocked Reverse Geocoded Address in ESRI Response, AUS',
+        'Addr_type': 'PointAddress',
+    },
+    'location': {'x': 115.72874704177, 'y': -31.733750976498},
+}
 GOOGLE_GEOCODE_RESP_MSG = {'results': [{
         'formatted_address': 'Mocked Geocoded Address in Google Response', 
-        'geometry': {'location': {'lat': -31.7337549, 'lng': 115.728749}}, 
+        'geometry': {'location': {'lat': -31.7337549, 'lng': 115.728749}, 'location_type': 'ROOFTOP'}, 
     }],
     'status': 'OK'
 }
@@ -37,12 +55,19 @@ def make_mock_transport(request_duration=REQUEST_DURATION):
         async def handle_async_request(self, request):
             req_url = request.url.scheme + '://' + request.url.host + request.url.path
 
-            await asyncio.sleep(request_duration)
+            REQUEST_COUNTS[req_url] += 1
+            await asyncio.sleep(REQUEST_DURATIONS.get(req_url, request_duration))
 
+            if request.method == 'HEAD':  # warm up
+                return self._make_response({}, 200)
+            if req_url in STATUS_CODES:
+                return self._make_response({}, STATUS_CODES[req_url])
             if req_url == esri.Geocoder.token_url:
                 return self._make_response(ESRI_TOKEN_RESP_MSG, 200)
             elif req_url == esri.Geocoder.geocode_url:
                 return self._make_response(ESRI_GEOCODE_RESP_MSG, 200)
+            elif req_url == esri.Geocoder.reverse_url:
+                return self._make_response(ESRI_REVERSE_RESP_MSG, 200)
             elif req_url == google.Geocoder.url:
                 return self._make_response(GOOGLE_GEOCODE_RESP_MSG, 200)
             else:
@@ -57,5 +82,11 @@ def make_mock_geocoder(Geocoder: Type[protocols.BulkAsyncGeocoder] = robust.Geoc
 
     class MockGeocoder(Geocoder):
         RequestClient = MockClient
+        warmup_resolve_dns = False
+
+    # Composite geocoders (e.g. robust) make some requests, such as the ESRI
+    # token, with their providers' own clients.
+    if hasattr(Geocoder, 'Providers'):
+        MockGeocoder.Providers = [make_mock_geocoder(Provider, request_duration) for Provider in Geocoder.Providers]
 
     return MockGeocoder
\ No newline at end of file
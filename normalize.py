@@ -0,0 +1,97 @@
+import re
+from typing import Optional, Tuple
+
+# Street types as they are commonly abbreviated in user input and in
+# address-point data such as G-NAF. Keys and values are both upper case.
+STREET_TYPES = {
+    'AL': 'ALLEY',
+    'APP': 'APPROACH',
+    'ARC': 'ARCADE',
+    'AV': 'AVENUE',
+    'AVE': 'AVENUE',
+    'BVD': 'BOULEVARD',
+    'BLVD': 'BOULEVARD',
+    'CCT': 'CIRCUIT',
+    'CL': 'CLOSE',
+    'CNR': 'CORNER',
+    'CRES': 'CRESCENT',
+    'CT': 'COURT',
+    'DR': 'DRIVE',
+    'ESP': 'ESPLANADE',
+    'GDNS': 'GARDENS',
+    'GR': 'GROVE',
+    'HWY': 'HIGHWAY',
+    'LN': 'LANE',
+    'LP': 'LOOP',
+    'PDE': 'PARADE',
+    'PL': 'PLACE',
+    'RD': 'ROAD',
+    'RDGE': 'RIDGE',
+    'SQ': 'SQUARE',
+    'ST': 'STREET',
+    'TCE': 'TERRACE',
+    'VSTA': 'VISTA',
+    'WY': 'WAY',
+}
+
+STATES = {'ACT', 'NSW', 'NT', 'QLD', 'SA', 'TAS', 'VIC', 'WA'}
+COUNTRIES = {'AUSTRALIA', 'AU', 'AUS'}
+
+_NOT_ADDRESS_CHARS = re.compile(r'[^A-Z0-9/\-, ]')
+_WHITESPACE = re.compile(r'\s+')
+_POSTCODE = re.compile(r'^\d{4}$')
+_HOUSE_NUMBER = re.compile(r'^(?:\d+[A-Z]?/)?(\d+)[A-Z]?(?:-\d+[A-Z]?)?\s+(.*)$')
+
+
+def _normalize_part(part: str, is_street: bool) -> str:
+    words = [word for word in _WHITESPACE.split(part.strip()) if word]
+    # Postcodes are dropped: sources disagree on whether they include them.
+    # In the street part only a trailing one can be a postcode, e.g. when
+    # the address has no commas at all.
+    if is_street:
+        if len(words) > 1 and _POSTCODE.match(words[-1]):
+            words.pop()
+    else:
+        words = [word for word in words if not _POSTCODE.match(word)]
+    return ' '.join(STREET_TYPES.get(word, word) for word in words)
+
+
+def _parts(address: str) -> list:
+    address = _NOT_ADDRESS_CHARS.sub(' ', address.upper())
+    parts = [_normalize_part(part, is_street=(i == 0)) for i, part in enumerate(address.split(','))]
+    parts = [part for part in parts if part]
+    while parts and parts[-1] in COUNTRIES:
+        parts.pop()
+    return parts
+
+
+def normalize_address(address: str) -> str:
+    '''
+    Canonical form of an address for use as a lookup key: upper case, no
+    punctuation, expanded street types, no postcode or trailing country, e.g.
+
+        '2 Achilles Lp., Iluka WA, Australia' -> '2 ACHILLES LOOP ILUKA WA'
+        '3 Aral Ct, ILUKA, WA 6028'          -> '3 ARAL COURT ILUKA WA'
+    '''
+    return ' '.join(_parts(address))
+
+
+def split_address(address: str) -> Tuple[Optional[int], str, str]:
+    '''
+    Split an address into (house_number, street, locality), all normalized.
+
+    The street is the first comma-separated part with its house number
+    removed; the locality is everything after it. `house_number` is None when
+    the street part doesn't start with one (and for unit numbers, such as
+    `3/12`, it is the street number 12).
+    '''
+    parts = _parts(address)
+    if not parts:
+        return None, '', ''
+
+    street, locality = parts[0], ' '.join(parts[1:])
+    match = _HOUSE_NUMBER.match(street)
+    if not match:
+        return None, street, locality
+
+    return int(match.group(1)), match.group(2), locality
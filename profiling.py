@@ -0,0 +1,170 @@
+'''
+Opt-in profiling of where geocoding time goes.
+
+While a `Profiler` is active, each address's time is recorded as nested
+spans: the whole `geocode`, then for each provider tried (`google`,
+`fallback:esri`, ...) its `semaphore_wait`, `throttle`, `token`, `network`
+and `parse` stages. Consumers of `geocode_gen` also record `queue_wait`,
+the time spent blocked waiting for the next result.
+
+    with profiling.profile() as profiler:
+        results = list(streamer.geocode_gen(addresses))
+    print(profiler.report())
+    profiler.write_folded('geocode.folded')  # flamegraph.pl / speedscope
+
+When no profiler is active, `span` returns a shared no-op context manager,
+so the instrumentation costs a global lookup per stage.
+'''
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+_stack: ContextVar[Tuple[str, ...]] = ContextVar('profiling_stack', default=())
+_address: ContextVar[Optional[str]] = ContextVar('profiling_address', default=None)
+_NOOP = nullcontext()
+
+# Process-wide, rather than a context variable, so that it reaches the
+# streamers' event loop threads.
+_active: Optional['Profiler'] = None
+
+
+@dataclass
+class StageStats:
+    count: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.seconds / self.count if self.count else 0.0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+
+class Profiler:
+    '''
+    Collects spans from every thread. `per_address` also keeps each
+    address's total time per stage in `addresses`.
+    '''
+
+    def __init__(self, per_address: bool = True):
+        self.per_address = per_address
+        self.paths: Dict[Tuple[str, ...], StageStats] = {}
+        self.addresses: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, path: Tuple[str, ...], seconds: float, address: Optional[str] = None) -> None:
+        with self._lock:
+            stats = self.paths.get(path)
+            if stats is None:
+                stats = self.paths[path] = StageStats()
+            stats.add(seconds)
+            if address is not None and self.per_address:
+                stages = self.addresses.setdefault(address, {})
+                stages[path[-1]] = stages.get(path[-1], 0.0) + seconds
+
+    @contextmanager
+    def span(self, stage: str):
+        path = _stack.get() + (stage,)
+        token = _stack.set(path)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            _stack.reset(token)
+            self.record(path, elapsed, _address.get())
+
+    @contextmanager
+    def address(self, address: str):
+        token = _address.set(address)
+        try:
+            with self.span('geocode'):
+                yield
+        finally:
+            _address.reset(token)
+
+    def breakdown(self) -> Dict[str, StageStats]:
+        '''Time per stage (inclusive of nested stages), summed over every path it appears on.'''
+        with self._lock:
+            paths = list(self.paths.items())
+        stages: Dict[str, StageStats] = {}
+        for path, stats in paths:
+            total = stages.setdefault(path[-1], StageStats())
+            total.count += stats.count
+            total.seconds += stats.seconds
+            total.max_seconds = max(total.max_seconds, stats.max_seconds)
+        return stages
+
+    def folded(self) -> str:
+        '''
+        Folded stacks ("geocode;google;network 1234") with each path's self
+        time in microseconds, the input format of flamegraph.pl and
+        speedscope. Concurrent children can add up to more than their
+        parent, so self time is clamped at zero.
+        '''
+        with self._lock:
+            inclusive = {path: stats.seconds for path, stats in self.paths.items()}
+        children = {}
+        for path, seconds in inclusive.items():
+            if len(path) > 1:
+                children[path[:-1]] = children.get(path[:-1], 0.0) + seconds
+
+        lines = []
+        for path in sorted(inclusive):
+            self_us = round(max(inclusive[path] - children.get(path, 0.0), 0.0) * 1e6)
+            if self_us:
+                lines.append(f'{";".join(path)} {self_us}')
+        return '\n'.join(lines) + '\n'
+
+    def write_folded(self, path: str) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.folded())
+
+    def report(self) -> str:
+        rows = sorted(self.breakdown().items(), key=lambda item: -item[1].seconds)
+        lines = [f'{"stage":<20} {"count":>8} {"total s":>10} {"mean ms":>10} {"max ms":>10}']
+        for stage, stats in rows:
+            lines.append(f'{stage:<20} {stats.count:>8} {stats.seconds:>10.3f} {stats.mean_seconds * 1e3:>10.2f} {stats.max_seconds * 1e3:>10.2f}')
+        return '\n'.join(lines)
+
+
+def span(stage: str):
+    '''Time the block as `stage`, nested in any enclosing span.'''
+    profiler = _active
+    return _NOOP if profiler is None else profiler.span(stage)
+
+
+def address(address: str):
+    '''Time the block as the `geocode` span of `address`.'''
+    profiler = _active
+    return _NOOP if profiler is None else profiler.address(address)
+
+
+def enable(profiler: Optional[Profiler] = None) -> Profiler:
+    global _active
+    _active = profiler or Profiler()
+    return _active
+
+
+def disable() -> None:
+    global _active
+    _active = None
+
+
+@contextmanager
+def profile(per_address: bool = True):
+    '''Profile everything geocoded within the block.'''
+    global _active
+    outer = _active
+    profiler = enable(Profiler(per_address))
+    try:
+        yield profiler
+    finally:
+        _active = outer
@@ -1,15 +1,24 @@
 
-from typing import AsyncGenerator, List, Protocol
+from typing import AsyncGenerator, List, Optional, Protocol, Tuple
 
 from common import GeocodedLocation
 
 
 class BulkAsyncGeocoder(Protocol):
+    timed_out: List[str]
     def __init__(self, rate_limit: int = 2): ...
-    async def geocode_async_gen(self, addresses: List[str], in_order=True) -> AsyncGenerator[GeocodedLocation, None]: ...
+    async def geocode_async_gen(self, addresses: List[str], in_order=True, deadline: Optional[float] = None, address_timeout: Optional[float] = None, lane: str = 'bulk') -> AsyncGenerator[GeocodedLocation, None]: ...
+
+
+class BulkAsyncReverseGeocoder(Protocol):
+    timed_out: List[str]
+    def __init__(self, rate_limit: int = 2): ...
+    async def reverse_geocode_async_gen(self, points: List[Tuple[float, float]], in_order=True, deadline: Optional[float] = None, address_timeout: Optional[float] = None, lane: str = 'bulk') -> AsyncGenerator[GeocodedLocation, None]: ...
 
 
 class AsyncGeocoder(Protocol):
     def __init__(self, rate_limit: int = 2): ...
+    async def warmup(self, client, connections: int = 2): ...
     async def geocode(self, address: str) -> GeocodedLocation: ...
     async def geocode_with_client(self, address: str, client) -> GeocodedLocation: ...
+    async def reverse_geocode_with_client(self, lat: float, lon: float, client) -> GeocodedLocation: ...
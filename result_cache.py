@@ -0,0 +1,312 @@
+'''
+A compact, read-only, memory-mapped cache of geocoding results, for
+read-heavy deployments where many worker processes look up the same
+large set of prior results.
+
+File layout (little endian):
+
+    header   magic, version, slot count, record count, offsets of the
+             records and the string pool
+    slots    open addressing hash table (linear probing, power of two
+             size): key hash, record number; a zero hash is an empty slot
+    records  fixed width: check hash, lat, lon, label offset, label length,
+             confidence, match level
+    strings  utf-8 geocode_address labels, each distinct label stored once
+
+Keys are normalized addresses, hashed to 128 bits: the first half picks
+and fills the slot and the second is checked in the record, so keys
+themselves aren't stored. It differs from `address_index`, which needs its
+keys for fuzzy matching, because a cache of tens of millions of results is
+mostly keys if they're stored, and because it's merged into repeatedly,
+where a hash table takes new entries without re-sorting. Mapping and
+replacing the file are shared with it (see `mapped_file`).
+
+Caches are built offline from results streamed out of `geocode_gen`, and
+compacted by merging an old cache with newer results, by way of a
+temporary on-disk table so memory use doesn't grow with the cache:
+
+    build_cache(streamer.geocode_gen(addresses), 'results.rgrc')
+    compact_cache(['results.rgrc'], streamer.geocode_gen(more), 'results.rgrc')
+
+Running geocoders pick up a replaced cache file within
+`SETTINGS.reopen_interval` seconds.
+'''
+import hashlib
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Type
+
+import protocols
+from common import GeocodedLocation, MATCH_LEVEL
+from mapped_file import MappedFile, file_id, replacing
+from normalize import normalize_address
+from strategies import robust
+
+MAGIC = b'RGRC'
+VERSION = 1
+HEADER = struct.Struct('<4sIQQQQ')
+SLOT = struct.Struct('<QQ')
+RECORD = struct.Struct('<QddQHfB')
+HASHES = struct.Struct('<QQ')
+
+_MATCH_LEVELS = list(MATCH_LEVEL)
+_MATCH_LEVEL_CODES = {level: i for i, level in enumerate(_MATCH_LEVELS)}
+
+_MASK64 = (1 << 64) - 1
+
+
+class SETTINGS:
+    # Seconds between `open_cache` checks for a replaced cache file.
+    reopen_interval = 5.0
+    # Seconds a replaced cache stays mapped for lookups already under way
+    # in other threads, before it is closed.
+    close_replaced_after = 5.0
+
+
+def key_hashes(key: str) -> Tuple[int, int]:
+    h, check = HASHES.unpack(hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest())
+    return h or 1, check  # zero marks an empty slot
+
+
+def _result_rows(results: Iterable[GeocodedLocation]) -> Iterator[tuple]:
+    for loc in results:
+        key = normalize_address(loc.address)
+        if not key or loc.is_null_island:
+            continue
+        yield key_hashes(key), loc.lat, loc.lon, loc.geocode_address, loc.confidence, MATCH_LEVEL(loc.match_level)
+
+
+def _signed(n: int) -> int:
+    # SQLite integers are signed 64 bit.
+    return n - (1 << 64) if n >= 1 << 63 else n
+
+
+class _Entries:
+    '''
+    Entries for a cache being built, kept in a temporary on-disk SQLite
+    database rather than in memory, so building or compacting a cache
+    needs memory for neither its records nor its labels. A later entry for
+    the same key replaces an earlier one.
+    '''
+
+    def __init__(self):
+        self.conn = sqlite3.connect('')  # private, deleted on close
+        self.conn.execute(
+            'CREATE TABLE entries (h INTEGER, check_hash INTEGER, lat REAL, lon REAL, label TEXT, confidence REAL, match_level INTEGER, '
+            'PRIMARY KEY (h, check_hash)) WITHOUT ROWID'
+        )
+
+    def add(self, rows: Iterable[tuple]) -> None:
+        '''Add ((hash, check), lat, lon, label, confidence, match level) rows.'''
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (
+                (_signed(h), _signed(check), lat, lon, label, confidence, _MATCH_LEVEL_CODES[match_level])
+                for (h, check), lat, lon, label, confidence, match_level in rows
+            ),
+        )
+
+    def add_results(self, results: Iterable[GeocodedLocation]) -> None:
+        self.add(_result_rows(results))
+
+    def write(self, path: str, load_factor: float) -> int:
+        if not 0 < load_factor < 1:
+            raise ValueError(f'load_factor must be between 0 and 1, not {load_factor}')
+        count, = self.conn.execute('SELECT COUNT(*) FROM entries').fetchone()
+        slot_count = 1
+        while slot_count * load_factor < max(count, 1):
+            slot_count *= 2
+        mask = slot_count - 1
+        records_offset = HEADER.size + slot_count * SLOT.size
+        strings_offset = records_offset + count * RECORD.size
+
+        with replacing(path) as f:
+            f.truncate(strings_offset)
+            with mmap.mmap(f.fileno(), strings_offset) as mm:
+                HEADER.pack_into(mm, 0, MAGIC, VERSION, slot_count, count, records_offset, strings_offset)
+                # Sorted by label, so each distinct label is written to the
+                # string pool once, when it is first seen.
+                f.seek(strings_offset)
+                label, label_off, label_len = None, 0, 0
+                rows = self.conn.execute('SELECT h, check_hash, lat, lon, label, confidence, match_level FROM entries ORDER BY label')
+                for i, (h, check, lat, lon, row_label, confidence, match_level) in enumerate(rows):
+                    if row_label != label:
+                        label_bytes = row_label.encode('utf-8')
+                        label, label_off, label_len = row_label, label_off + label_len, len(label_bytes)
+                        f.write(label_bytes)
+                    RECORD.pack_into(mm, records_offset + i * RECORD.size, check & _MASK64, lat, lon, label_off, label_len, confidence, match_level)
+
+                    h &= _MASK64
+                    slot = h & mask
+                    while SLOT.unpack_from(mm, HEADER.size + slot * SLOT.size)[0]:
+                        slot = (slot + 1) & mask
+                    SLOT.pack_into(mm, HEADER.size + slot * SLOT.size, h, i)
+                mm.flush()
+
+        return count
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def build_cache(results: Iterable[GeocodedLocation], path: str, load_factor: float = 0.5) -> int:
+    '''
+    Write a cache of `results` to `path`. Later results for the same
+    normalized address replace earlier ones, and null_island results (failed
+    or timed out) aren't cached. Returns the number of records written.
+    '''
+    return compact_cache([], results, path, load_factor)
+
+
+def compact_cache(paths: List[str], results: Iterable[GeocodedLocation], path: str, load_factor: float = 0.5) -> int:
+    '''
+    Merge the caches at `paths` (later ones win) and then `results` into a
+    new cache at `path`, which may be one of `paths`. Labels no longer used
+    are dropped and the rest are interned again.
+    '''
+    entries = _Entries()
+    try:
+        for old_path in paths:
+            cache = ResultCache(old_path)
+            try:
+                entries.add(cache.items())
+            finally:
+                cache.close()
+        entries.add_results(results)
+        return entries.write(path, load_factor)
+    finally:
+        entries.close()
+
+
+class ResultCache(MappedFile):
+    HEADER, MAGIC, VERSION = HEADER, MAGIC, VERSION
+    KIND = 'a result cache'
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.slot_count, self.count, self.records_offset, self.strings_offset = self.fields
+        self._mask = self.slot_count - 1
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _find(self, key: str) -> Optional[tuple]:
+        h, check = key_hashes(key)
+        slot = h & self._mask
+        while True:
+            slot_hash, i = SLOT.unpack_from(self.mm, HEADER.size + slot * SLOT.size)
+            if not slot_hash:
+                return None
+            if slot_hash == h:
+                record = RECORD.unpack_from(self.mm, self.records_offset + i * RECORD.size)
+                if record[0] == check:
+                    return record
+            slot = (slot + 1) & self._mask
+
+    def get(self, address: str) -> Optional[GeocodedLocation]:
+        '''The cached result for `address` (matched after normalization), or None.'''
+        return self.get_key(normalize_address(address), address)
+
+    def get_key(self, key: str, address: Optional[str] = None) -> Optional[GeocodedLocation]:
+        '''
+        Like `get`, for an already normalized key. Normalizing costs several
+        times more than the lookup itself, so callers with keys should use this.
+        '''
+        record = self._find(key)
+        if record is None:
+            return None
+        _, lat, lon, label_off, label_len, confidence, match_level = record
+        return GeocodedLocation(
+            address=key if address is None else address,
+            lat=lat,
+            lon=lon,
+            geocode_address=self._string(label_off, label_len),
+            confidence=round(confidence, 3),
+            match_level=_MATCH_LEVELS[match_level],
+        )
+
+    def __contains__(self, address: str) -> bool:
+        return self._find(normalize_address(address)) is not None
+
+    def items(self) -> Iterator[tuple]:
+        '''((hash, check), lat, lon, label, confidence, match level) for every record.'''
+        for slot in range(self.slot_count):
+            h, i = SLOT.unpack_from(self.mm, HEADER.size + slot * SLOT.size)
+            if not h:
+                continue
+            check, lat, lon, label_off, label_len, confidence, match_level = RECORD.unpack_from(self.mm, self.records_offset + i * RECORD.size)
+            yield (h, check), lat, lon, self._string(label_off, label_len), round(confidence, 3), _MATCH_LEVELS[match_level]
+
+
+# path -> (cache, when its file was last checked)
+_open: Dict[str, Tuple[ResultCache, float]] = {}
+# Caches whose file has been replaced, and when, waiting to be closed.
+_replaced: List[Tuple[ResultCache, float]] = []
+_open_lock = threading.Lock()
+
+
+def _close_replaced(now: float) -> None:
+    while _replaced and now - _replaced[0][1] >= SETTINGS.close_replaced_after:
+        _replaced.pop(0)[0].close()
+
+
+def open_cache(path: str) -> ResultCache:
+    '''
+    Every Geocoder in the process shares one mapping per cache file. At most
+    every `SETTINGS.reopen_interval` seconds the file is checked, and
+    reopened if it has been replaced (e.g. compacted). The old mapping is
+    closed `SETTINGS.close_replaced_after` seconds later, which also frees
+    the replaced file's disk space, so call this for each lookup rather
+    than holding on to the cache.
+    '''
+    now = time.monotonic()
+    opened = _open.get(path)
+    if opened is not None and now - opened[1] < SETTINGS.reopen_interval:
+        return opened[0]
+
+    with _open_lock:
+        opened = _open.get(path)
+        if opened is not None and now - opened[1] < SETTINGS.reopen_interval:
+            return opened[0]
+        _close_replaced(now)
+        cache = opened[0] if opened is not None else None
+        if cache is None or cache.file_id != file_id(os.stat(path)):
+            if cache is not None:
+                _replaced.append((cache, now))
+            cache = ResultCache(path)
+        _open[path] = (cache, now)
+        return cache
+
+
+def make_cached_geocoder(path: str, Geocoder: Type[protocols.AsyncGeocoder] = robust.Geocoder):
+    '''
+    Wrap a Geocoder so addresses in the cache at `path` are answered from it
+    without a request or a rate limit slot:
+
+        Geocoder = make_cached_geocoder('results.rgrc')
+        streamer = GeocodeStreamerQueue(Geocoder=Geocoder)
+    '''
+    open_cache(path)  # fail now if it isn't a cache
+
+    class CachedGeocoder(Geocoder):
+        @property
+        def cache(self) -> ResultCache:
+            return open_cache(path)
+
+        async def geocode_with_client(self, address: str, client) -> GeocodedLocation:
+            cached = self.cache.get(address)
+            if cached is not None:
+                return cached
+            return await super().geocode_with_client(address, client)
+
+        async def _geocode_or_raise(self, address: str, client) -> GeocodedLocation:
+            cached = self.cache.get(address)
+            if cached is not None:
+                return cached
+            return await super()._geocode_or_raise(address, client)
+
+    return CachedGeocoder
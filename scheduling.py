@@ -0,0 +1,214 @@
+import asyncio
+from collections import defaultdict
+import dataclasses
+from functools import partial
+import logging
+from typing import Any, AsyncGenerator, Dict, List, Optional, Set, Tuple, Type
+
+import deadlines
+import lanes
+import protocols
+from common import GeocodedLocation, GeocoderError, FailedGeocodeError, MATCH_LEVEL, MATCH_LEVEL_CONFIDENCE
+from normalize import normalize_address, split_address
+from strategies import robust
+
+logger = logging.getLogger(__name__)
+
+
+class SETTINGS:
+    # A locality is only written off once at least this many representatives
+    # (where it has that many addresses) have failed to geocode.
+    min_locality_probes = 2
+    # Interpolated results are never more confident than this fraction of
+    # their least confident endpoint.
+    interpolation_penalty = 0.9
+    interpolation_endpoint_levels = {MATCH_LEVEL.ROOFTOP, MATCH_LEVEL.INTERPOLATED}
+
+
+@dataclasses.dataclass
+class Group:
+    '''Addresses on the same street (and side of the street, if interpolating).'''
+    locality: str
+    street: str
+    members: List[Tuple[Optional[int], str]] = dataclasses.field(default_factory=list)
+
+    def representatives(self, approximate: bool) -> List[Tuple[Optional[int], str]]:
+        if not approximate:
+            return self.members[:1]
+
+        numbered = sorted((m for m in self.members if m[0] is not None), key=lambda m: m[0])
+        if len(numbered) < 2:
+            return self.members[:1]
+        return [numbered[0], numbered[-1]]
+
+
+@dataclasses.dataclass
+class Job:
+    '''The state of one `geocode_async_gen` call, so concurrent calls don't share it.'''
+    client: Any
+    job_deadline: Optional[float]
+    address_timeout: Optional[float]
+    # Addresses every provider had no match for.
+    unmatched: Set[str] = dataclasses.field(default_factory=set)
+
+
+def group_addresses(addresses: List[str], approximate: bool = False) -> Dict[str, List[Group]]:
+    '''
+    Group addresses by locality, then by street. When `approximate` is set,
+    odd and even house numbers are separate groups so that interpolation
+    happens along one side of the street.
+    '''
+    groups = {}
+    for address in addresses:
+        house_number, street, locality = split_address(address)
+        parity = house_number % 2 if (approximate and house_number is not None) else None
+        key = (locality, street, parity)
+        if key not in groups:
+            groups[key] = Group(locality=locality, street=street)
+        groups[key].members.append((house_number, address))
+
+    by_locality = defaultdict(list)
+    for group in groups.values():
+        by_locality[group.locality].append(group)
+    return by_locality
+
+
+def interpolate(house_number: int, lo: Tuple[int, GeocodedLocation], hi: Tuple[int, GeocodedLocation], address: str) -> Optional[GeocodedLocation]:
+    (lo_number, lo_loc), (hi_number, hi_loc) = lo, hi
+    if not (lo_number < house_number < hi_number):
+        return None
+    if not {lo_loc.match_level, hi_loc.match_level} <= SETTINGS.interpolation_endpoint_levels:
+        return None
+
+    t = (house_number - lo_number) / (hi_number - lo_number)
+    confidence = min(
+        lo_loc.confidence * SETTINGS.interpolation_penalty,
+        hi_loc.confidence * SETTINGS.interpolation_penalty,
+        MATCH_LEVEL_CONFIDENCE[MATCH_LEVEL.INTERPOLATED],
+    )
+    return GeocodedLocation(
+        address=address,
+        lat=round(lo_loc.lat + t * (hi_loc.lat - lo_loc.lat), 6),
+        lon=round(lo_loc.lon + t * (hi_loc.lon - lo_loc.lon), 6),
+        geocode_address=f'{address} (interpolated)',
+        confidence=round(confidence, 3),
+        match_level=MATCH_LEVEL.INTERPOLATED,
+    )
+
+
+def make_locality_geocoder(Geocoder: Type[protocols.AsyncGeocoder] = robust.Geocoder, approximate: bool = False):
+    '''
+    Wrap a Geocoder so that `geocode_async_gen` schedules work by street and
+    locality instead of one request per input row:
+
+    - Duplicate addresses (after normalization) are geocoded once.
+    - One representative per street is geocoded before any of its siblings.
+    - If every representative in a locality fails, the locality doesn't
+      geocode at all and its remaining addresses go straight to null_island.
+    - With `approximate=True`, the lowest and highest house number on each
+      side of a street are the representatives, and the house numbers in
+      between are interpolated from them instead of being requested.
+
+    The result is a drop-in Geocoder class for the streamers:
+
+        Geocoder = make_locality_geocoder(robust.Geocoder, approximate=True)
+        streamer = GeocodeStreamerQueue(Geocoder=Geocoder)
+    '''
+    class LocalityGeocoder(Geocoder):
+        async def _geocode_or_null(self, address: str, job: Job) -> GeocodedLocation:
+            geocode = partial(self._geocode_or_raise, address, job.client)
+            try:
+                return await self._before_deadline(address, geocode, job.job_deadline, job.address_timeout)
+            except FailedGeocodeError:
+                job.unmatched.add(address)
+                return GeocodedLocation.null_island(address)
+            except GeocoderError:
+                return GeocodedLocation.null_island(address)
+
+        async def _geocode_sibling(self, house_number, address, group_reps, locality_reps, job: Job) -> GeocodedLocation:
+            probes = await asyncio.gather(*locality_reps)
+            # Only probes that found no match say anything about the locality,
+            # not ones that hit rate limits, server errors or ran out of time.
+            if all(loc.address in job.unmatched for loc in probes):
+                logger.info(f'[{self.name}]: Skipping "{address}", no address in its locality geocoded')
+                return GeocodedLocation.null_island(address)
+
+            if approximate and house_number is not None and len(group_reps) == 2:
+                (lo_number, lo_task), (hi_number, hi_task) = group_reps
+                loc = interpolate(house_number, (lo_number, await lo_task), (hi_number, await hi_task), address)
+                if loc:
+                    return loc
+
+            return await self._geocode_or_null(address, job)
+
+        def _schedule(self, addresses: List[str], job: Job) -> Dict[str, asyncio.Task]:
+            unique = {}
+            for address in addresses:
+                unique.setdefault(normalize_address(address), address)
+
+            by_locality = group_addresses(list(unique.values()), approximate)
+            tasks = {}
+            siblings = []
+
+            # All representatives are created first so they reach the
+            # rate limiter ahead of every sibling.
+            for groups in by_locality.values():
+                locality_reps = []
+                all_reps = []
+                for group in groups:
+                    reps = group.representatives(approximate)
+                    group_reps = []
+                    for house_number, address in reps:
+                        task = asyncio.create_task(self._geocode_or_null(address, job))
+                        tasks[normalize_address(address)] = task
+                        group_reps.append((house_number, task))
+                        locality_reps.append(task)
+                    all_reps.append((group, group_reps))
+
+                for group, group_reps in all_reps:
+                    rep_addresses = {address for _, address in group.representatives(approximate)}
+                    for house_number, address in group.members:
+                        if address not in rep_addresses:
+                            siblings.append((house_number, address, group_reps, locality_reps))
+
+            # A single failed probe isn't enough to write off a locality.
+            for house_number, address, group_reps, locality_reps in siblings:
+                if len(locality_reps) < SETTINGS.min_locality_probes:
+                    locality_reps.append(asyncio.create_task(self._geocode_or_null(address, job)))
+                    tasks[normalize_address(address)] = locality_reps[-1]
+                    continue
+                tasks[normalize_address(address)] = asyncio.create_task(
+                    self._geocode_sibling(house_number, address, group_reps, locality_reps, job)
+                )
+
+            return tasks
+
+        async def geocode_async_gen(self, addresses: List[str], in_order=True, deadline: Optional[float] = None, address_timeout: Optional[float] = None, lane: str = lanes.BULK) -> AsyncGenerator[GeocodedLocation, None]:
+            job_deadline = deadlines.after(deadline)
+            async with self.RequestClient() as client, self._warming_up(client):
+                with lanes.scope(lane):
+                    tasks = self._schedule(addresses, Job(client, job_deadline, address_timeout))
+                keys = [normalize_address(address) for address in addresses]
+
+                try:
+                    if in_order:
+                        for address, key in zip(addresses, keys):
+                            loc = await tasks[key]
+                            yield dataclasses.replace(loc, address=address)
+                        return
+
+                    addresses_by_key = defaultdict(list)
+                    for address, key in zip(addresses, keys):
+                        addresses_by_key[key].append(address)
+
+                    async def keyed(key, task):
+                        return key, await task
+
+                    for next_done in asyncio.as_completed([keyed(key, task) for key, task in tasks.items()]):
+                        key, loc = await next_done
+                        for address in addresses_by_key[key]:
+                            yield dataclasses.replace(loc, address=address)
+                finally:
+                    await self._cancel(tasks.values())
+
+    return LocalityGeocoder
@@ -0,0 +1,105 @@
+from collections import defaultdict
+import math
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from common import GeocodedLocation
+
+EARTH_RADIUS_M = 6_371_008.8
+METRES_PER_DEGREE = 111_320
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+class SpatialResultStore:
+    '''
+    Indexes geocoded results in a fixed-size lat/lon grid so that a run's
+    results can be queried by radius or bounding box as they arrive.
+
+    Wrap the streamer's generator with `record()` to build the index
+    incrementally:
+
+        store = SpatialResultStore()
+        for loc in store.record(streamer.geocode_gen(addresses)):
+            ...
+        store.within_radius(-31.73, 115.73, metres=200)
+
+    `null_island` fallbacks are kept out of the grid (they would all pile up
+    at 0,0) and are available separately via `null_island`.
+    '''
+
+    def __init__(self, cell_size_deg: float = 0.01):
+        self.cell_size_deg = cell_size_deg
+        self.cells: Dict[Tuple[int, int], List[GeocodedLocation]] = defaultdict(list)
+        self.by_point: Dict[Tuple[float, float], List[GeocodedLocation]] = defaultdict(list)
+        self.null_island: List[GeocodedLocation] = []
+
+    def __len__(self) -> int:
+        return sum(len(locs) for locs in self.by_point.values())
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return (
+            math.floor(lat / self.cell_size_deg),
+            math.floor(lon / self.cell_size_deg),
+        )
+
+    def add(self, loc: GeocodedLocation) -> None:
+        if loc.is_null_island:
+            self.null_island.append(loc)
+            return
+        self.cells[self._cell(loc.lat, loc.lon)].append(loc)
+        self.by_point[(loc.lat, loc.lon)].append(loc)
+
+    def record(self, results: Iterable[GeocodedLocation]) -> Iterator[GeocodedLocation]:
+        '''Pass results through unchanged, indexing each one on the way.'''
+        for loc in results:
+            self.add(loc)
+            yield loc
+
+    def _cells_in_bbox(self, min_lat, min_lon, max_lat, max_lon) -> Iterator[List[GeocodedLocation]]:
+        lat_lo, lon_lo = self._cell(min_lat, min_lon)
+        lat_hi, lon_hi = self._cell(max_lat, max_lon)
+
+        # Sparse results over a large box: cheaper to scan the occupied cells.
+        if (lat_hi - lat_lo + 1) * (lon_hi - lon_lo + 1) > len(self.cells):
+            for (cell_lat, cell_lon), locs in self.cells.items():
+                if lat_lo <= cell_lat <= lat_hi and lon_lo <= cell_lon <= lon_hi:
+                    yield locs
+            return
+
+        for cell_lat in range(lat_lo, lat_hi + 1):
+            for cell_lon in range(lon_lo, lon_hi + 1):
+                locs = self.cells.get((cell_lat, cell_lon))
+                if locs:
+                    yield locs
+
+    def within_bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> List[GeocodedLocation]:
+        return [
+            loc
+            for locs in self._cells_in_bbox(min_lat, min_lon, max_lat, max_lon)
+            for loc in locs
+            if min_lat <= loc.lat <= max_lat and min_lon <= loc.lon <= max_lon
+        ]
+
+    def within_radius(self, lat: float, lon: float, metres: float) -> List[GeocodedLocation]:
+        dlat = metres / METRES_PER_DEGREE
+        dlon = metres / (METRES_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+        return [
+            loc
+            for locs in self._cells_in_bbox(lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+            for loc in locs
+            if haversine_m(lat, lon, loc.lat, loc.lon) <= metres
+        ]
+
+    def duplicates(self, min_count: int = 2) -> Dict[Tuple[float, float], List[GeocodedLocation]]:
+        '''Points that several input addresses resolved to, e.g. a street centroid.'''
+        return {
+            point: locs
+            for point, locs in self.by_point.items()
+            if len(locs) >= min_count
+        }
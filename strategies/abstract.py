@@ -1,25 +1,109 @@
 from abc import ABC, abstractmethod
 import asyncio
-from json import JSONDecodeError
-from typing import AsyncGenerator, Generator, List, Protocol
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field, replace
+from functools import partial
+from typing import AsyncGenerator, Generator, Hashable, List, Optional, Protocol, Tuple
 import httpx
 import logging
+import threading
+import time
 
+import coordination
+import deadlines
+import fast_json
+import lanes
+import profiling
 from common import (
     GeocodedLocation,
     BadRequestError, GeocoderError, FailedGeocodeError, 
     BadAuthError, RateLimitError, ConnectionError, 
-    ServerError,
+    ServerError, DeadlineExceededError, NotSupportedError,
 )
 
 
 logger = logging.getLogger(__name__)
 
+
+def reverse_query(lat: float, lon: float) -> str:
+    return f'{lat},{lon}'
+
+
+@dataclass
+class WarmupReport:
+    '''How long `Geocoder.warmup` took, in seconds, and what it did.'''
+    geocoder: str
+    seconds: float = 0.0
+    dns_seconds: float = 0.0
+    connect_seconds: float = 0.0
+    prefetch_seconds: float = 0.0
+    connections: int = 0
+    providers: List['WarmupReport'] = field(default_factory=list)
+
+
+class RecentResults:
+    '''The `size` most recently used results, safe to share between threads.'''
+
+    def __init__(self, size: int):
+        self.size = size
+        self._results: 'OrderedDict[Hashable, GeocodedLocation]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def get(self, key: Hashable) -> Optional[GeocodedLocation]:
+        with self._lock:
+            loc = self._results.get(key)
+            if loc is not None:
+                self._results.move_to_end(key)
+            return loc
+
+    def put(self, key: Hashable, loc: GeocodedLocation) -> None:
+        with self._lock:
+            self._results[key] = loc
+            self._results.move_to_end(key)
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+
+
 class Geocoder(ABC):
     RequestClient = httpx.AsyncClient
+    # Geocoders with the same provider share one concurrency limit per
+    # process (see `lanes`). None gives each instance its own.
+    provider: Optional[str] = None
+    # Fleet-wide rate limits and result cache, off unless set (see `coordination`).
+    coordinator: Optional[coordination.Coordinator] = None
+    # Upper bound on a single HTTP request, so that a hung connection fails
+    # over to the next provider. Tightened further by any deadline in scope.
+    request_timeout = 10.0
+    # Deadlines end a lookup from the inside (`_send` raises
+    # DeadlineExceededError), so composite geocoders can still return what
+    # they have. The outer timer only fires this many seconds later, as a
+    # backstop for anything that doesn't watch the deadline.
+    deadline_slack = 0.5
+    # Reverse geocoding shares one lookup per cell of this many decimal
+    # places (4 is about 11m).
+    supports_reverse = False
+    reverse_precision = 4
+    # Successful reverse lookups by cell, shared by every geocoder in the
+    # process, so later batches don't ask again for cells already answered.
+    reverse_results = RecentResults(100_000)
+    # Endpoints `warmup` connects to ahead of the first request, and whether
+    # it resolves their hostnames first (mocks turn this off to stay offline).
+    warmup_urls: Tuple[str, ...] = ()
+    warmup_resolve_dns = True
 
     def __init__(self, rate_limit: int = 2):
-        self.semaphore = asyncio.Semaphore(rate_limit)
+        # The provider's shared limiter grows to `rate_limit` if it's
+        # smaller, but never shrinks; see `lanes.shared_limiter`.
+        self.semaphore = lanes.shared_limiter(self.provider, rate_limit)
+        self.timed_out: List[str] = []
+        self._reverse_lookups = {}
+        # Connections per endpoint to warm up alongside each batch (0: don't).
+        self.warmup_connections = 0
+        self.warmup_report: Optional[WarmupReport] = None
     
     @abstractmethod
     async def _prepare_request(self, address: str) -> httpx.Request:
@@ -29,16 +113,32 @@ class Geocoder(ABC):
     async def _response_to_location(self, address: str, response: dict) -> GeocodedLocation:
         ...
         
-    async def _call_with_client(self, address, client) -> dict:
-        req = await self._prepare_request(address)
+    async def _prepare_reverse_request(self, lat: float, lon: float) -> httpx.Request:
+        raise NotSupportedError(f'[{self.name}]: Reverse geocoding is not supported')
+
+    async def _reverse_response_to_location(self, query: str, response: dict) -> GeocodedLocation:
+        raise NotSupportedError(f'[{self.name}]: Reverse geocoding is not supported')
+
+    async def _send(self, req: httpx.Request, query: str, client) -> dict:
+        timeout = deadlines.timeout(self.request_timeout)
+        if deadlines.expired():
+            raise DeadlineExceededError()
+        req.extensions['timeout'] = httpx.Timeout(timeout).as_dict()
+
         try: 
-            resp = await client.send(req)
+            with profiling.span('network'):
+                resp = await asyncio.wait_for(client.send(req), timeout)
+        except (httpx.TimeoutException, asyncio.TimeoutError):
+            logger.error(f'[{self.name}]: Timed out geocoding address: "{query}" after {timeout:.1f}s')
+            if deadlines.expired():
+                raise DeadlineExceededError()
+            raise ConnectionError()
         except httpx.RequestError as e:
-            logger.error(f'[{self.name}]: Error geocoding address: "{address}". HTTPX Error: {e}')
+            logger.error(f'[{self.name}]: Error geocoding address: "{query}". HTTPX Error: {e}')
             raise ConnectionError()
         
         if not resp.status_code == 200:
-            logger.error(f'[{self.name}]: Error geocoding address: "{address}". Status: {resp.status_code}. Response: {resp.text}')
+            logger.error(f'[{self.name}]: Error geocoding address: "{query}". Status: {resp.status_code}. Response: {resp.text}')
             if resp.status_code == 400:
                 raise BadRequestError()
             if resp.status_code in {401, 403}:
@@ -52,35 +152,270 @@ class Geocoder(ABC):
             raise GeocoderError()
 
         try:
-            body = resp.json()
-        except JSONDecodeError as e:
-            logger.error(f'[{self.name}]: Error geocoding address: "{address}". Status: {resp.status_code}. Could not JSON decode response: {resp.text}')
+            with profiling.span('parse'):
+                body = self._decode_body(resp.content)
+        except fast_json.DecodeError:
+            logger.error(f'[{self.name}]: Error geocoding address: "{query}". Status: {resp.status_code}. Could not JSON decode response: {resp.text}')
             raise GeocoderError()
 
         return body
 
+    def _decode_body(self, content: bytes) -> dict:
+        return fast_json.loads(content)
+
+    async def _call_with_client(self, address, client) -> dict:
+        req = await self._prepare_request(address)
+        return await self._send(req, address, client)
+
     async def _call(self, address):
         async with self.RequestClient() as client:
             return await self._call_with_client(address, client)
 
     async def geocode(self, address: str) -> GeocodedLocation:
-        response = await self._call(address)
-        return await self._response_to_location(address, response)
-    
-    async def geocode_with_client(self, address: str, client) -> GeocodedLocation:
         async with self.semaphore:
-            response = await self._call_with_client(address, client)
+            response = await self._call(address)
         return await self._response_to_location(address, response)
+
+    async def _request_with_client(self, query: str, client, prepare, to_location, cache_key: Optional[str] = None) -> GeocodedLocation:
+        '''
+        One rate limited, cached request: `prepare()` builds the request and
+        `to_location(response)` turns the response into a GeocodedLocation.
+        '''
+        coordinator = self.coordinator
+        if coordinator:
+            cached = await coordinator.get_cached(self.provider, query, cache_key)
+            if cached:
+                return cached
+
+        with profiling.span('semaphore_wait'):
+            timeout = deadlines.timeout()
+            if timeout is None:
+                await self.semaphore.acquire()
+            else:
+                try:
+                    await asyncio.wait_for(self.semaphore.acquire(), timeout)
+                except asyncio.TimeoutError:
+                    raise DeadlineExceededError()
+        try:
+            if coordinator:
+                with profiling.span('throttle'):
+                    await coordinator.throttle(self.provider)
+            response = await self._send(await prepare(), query, client)
+        finally:
+            self.semaphore.release()
+        loc = await to_location(response)
+
+        if coordinator:
+            await coordinator.store(self.provider, loc, cache_key)
+        return loc
     
-    async def geocode_async_gen(self, addresses: List[str], in_order=True) -> AsyncGenerator[GeocodedLocation, None]:
-        async with self.RequestClient() as client:
-            coros = (self.geocode_with_client(address, client) for address in addresses)
-            tasks = [asyncio.create_task(coro) for coro in coros]  # tasks actually start running here.
+    async def geocode_with_client(self, address: str, client) -> GeocodedLocation:
+        return await self._request_with_client(
+            address, client,
+            prepare=partial(self._prepare_request, address),
+            to_location=partial(self._response_to_location, address),
+        )
 
-            tasks = tasks if in_order else asyncio.as_completed(tasks)
+    async def _geocode_or_raise(self, address: str, client) -> GeocodedLocation:
+        '''
+        Like `geocode_with_client`, but failure always raises: FailedGeocodeError
+        when the address doesn't geocode, and other GeocoderErrors (rate
+        limits, server and connection errors) when a retry might succeed.
+        Geocoders whose `geocode_with_client` returns null_island override this.
+        '''
+        return await self.geocode_with_client(address, client)
 
-            for result in tasks:
-                yield await result
+    async def _reverse_lookup(self, lat: float, lon: float, client) -> GeocodedLocation:
+        query = reverse_query(lat, lon)
+        return await self._request_with_client(
+            query, client,
+            prepare=partial(self._prepare_reverse_request, lat, lon),
+            to_location=partial(self._reverse_response_to_location, query),
+            cache_key=f'reverse:{query}',
+        )
+
+    async def reverse_geocode_with_client(self, lat: float, lon: float, client) -> GeocodedLocation:
+        '''
+        Coordinates are rounded to `reverse_precision` decimal places and
+        every point in the same cell shares one lookup, so dense telemetry
+        costs one request per cell rather than one per ping. Lookups in
+        flight are shared, and successful ones are then kept in
+        `reverse_results`; failures aren't kept.
+        '''
+        cell = (round(lat, self.reverse_precision), round(lon, self.reverse_precision))
+        loc = self.reverse_results.get((type(self), cell))
+        if loc is None:
+            lookup = self._reverse_lookups.get(cell)
+            if lookup is None:
+                lookup = self._reverse_lookups[cell] = asyncio.ensure_future(self._reverse_lookup(*cell, client))
+                lookup.add_done_callback(partial(self._reverse_lookup_done, cell))
+            loc = await asyncio.shield(lookup)
+        return replace(loc, address=reverse_query(lat, lon))
+
+    def _reverse_lookup_done(self, cell: Tuple[float, float], lookup: asyncio.Future) -> None:
+        self._reverse_lookups.pop(cell, None)
+        if not lookup.cancelled() and lookup.exception() is None and not lookup.result().is_null_island:
+            self.reverse_results.put((type(self), cell), lookup.result())
+
+    async def _before_deadline(self, query: str, make_coro, job_deadline: Optional[float], address_timeout: Optional[float]) -> GeocodedLocation:
+        '''
+        Await `make_coro()`, but give up at the job deadline or after
+        `address_timeout` seconds, whichever is sooner. The deadline is put in
+        scope for `make_coro()` to end itself with (see `deadline_slack`), and
+        queries that run out of time without an answer are recorded in
+        `timed_out` and come back as `GeocodedLocation.timed_out` rather than
+        raising.
+        '''
+        with profiling.address(query):
+            if job_deadline is None and address_timeout is None:
+                return await make_coro()
+
+            at = min(t for t in (job_deadline, deadlines.after(address_timeout)) if t is not None)
+            with deadlines.scope(at):
+                try:
+                    return await asyncio.wait_for(make_coro(), deadlines.timeout() + self.deadline_slack)
+                except (asyncio.TimeoutError, DeadlineExceededError):
+                    logger.warning(f'[{self.name}]: Ran out of time geocoding address: "{query}"')
+                    self.timed_out.append(query)
+                    return GeocodedLocation.timed_out(query)
+
+    async def _geocode_before_deadline(self, address: str, client, job_deadline: Optional[float], address_timeout: Optional[float]) -> GeocodedLocation:
+        return await self._before_deadline(address, partial(self.geocode_with_client, address, client), job_deadline, address_timeout)
+
+    async def _prefetch(self) -> None:
+        '''Provider specific set up for `warmup` to do early, such as fetching a token.'''
+
+    async def _open_connection(self, client, url: str) -> bool:
+        # Any response at all leaves a connection in the client's pool.
+        root = httpx.URL(url).copy_with(path='/', query=None)
+        try:
+            await client.head(root, timeout=deadlines.timeout(self.request_timeout))
+        except httpx.HTTPError as e:
+            logger.warning(f'[{self.name}]: Could not warm up a connection to {root.host}: {e}')
+            return False
+        return True
+
+    async def _timed_prefetch(self, report: WarmupReport) -> None:
+        started = time.perf_counter()
+        try:
+            await self._prefetch()
+        except (GeocoderError, httpx.HTTPError, KeyError, fast_json.DecodeError) as e:
+            logger.warning(f'[{self.name}]: Warm up prefetch failed: {e!r}')
+        report.prefetch_seconds = time.perf_counter() - started
+
+    async def warmup(self, client, connections: int = 2) -> WarmupReport:
+        '''
+        Resolve DNS for and open `connections` pooled connections on `client`
+        to each of `warmup_urls`, and do any `_prefetch` work, so the first
+        requests of a batch run at steady state latency. Failures are logged
+        rather than raised; the requests themselves will retry whatever
+        didn't work.
+        '''
+        report = WarmupReport(self.name)
+        started = time.perf_counter()
+
+        if self.warmup_resolve_dns and self.warmup_urls:
+            loop = asyncio.get_running_loop()
+            hosts = {httpx.URL(url).host for url in self.warmup_urls}
+            await asyncio.gather(*(loop.getaddrinfo(host, 443) for host in hosts), return_exceptions=True)
+            report.dns_seconds = time.perf_counter() - started
+
+        connecting = time.perf_counter()
+        opened, _ = await asyncio.gather(
+            asyncio.gather(*(self._open_connection(client, url) for url in self.warmup_urls for _ in range(connections))),
+            self._timed_prefetch(report),
+        )
+        report.connect_seconds = time.perf_counter() - connecting
+        report.connections = sum(opened)
+        report.seconds = time.perf_counter() - started
+
+        logger.info(f'[{self.name}]: Warmed up in {report.seconds:.3f}s ({report.connections} connections)')
+        return report
+
+    @asynccontextmanager
+    async def _warming_up(self, client):
+        '''
+        Run `warmup` alongside the block, when `warmup_connections` is set,
+        rather than before it, so the first requests aren't held back behind
+        it. Warm-up fills the pool for the requests after them.
+        '''
+        if not self.warmup_connections:
+            yield
+            return
+
+        warming = asyncio.create_task(self.warmup(client, self.warmup_connections))
+        try:
+            yield
+            self.warmup_report = await warming
+        finally:
+            await self._cancel([warming])
+
+    @staticmethod
+    async def _cancel(tasks) -> None:
+        '''
+        Cancel whichever of `tasks` are still running, and wait for them to
+        finish so that they give their rate limit slots back.
+        '''
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _results_gen(self, make_coros, in_order: bool, lane: str) -> AsyncGenerator[GeocodedLocation, None]:
+        async with self.RequestClient() as client, self._warming_up(client):
+            with lanes.scope(lane):
+                tasks = [asyncio.create_task(coro) for coro in make_coros(client)]  # tasks actually start running here.
+
+            try:
+                for result in (tasks if in_order else asyncio.as_completed(tasks)):
+                    yield await result
+            finally:
+                # The consumer may stop early.
+                await self._cancel(tasks)
+
+    async def geocode_async_gen(self, addresses: List[str], in_order=True, deadline: Optional[float] = None, address_timeout: Optional[float] = None, lane: str = lanes.BULK) -> AsyncGenerator[GeocodedLocation, None]:
+        '''
+        `deadline` is a budget in seconds for the whole of `addresses` and
+        `address_timeout` a budget for each one. Either way, whatever isn't
+        done in time is yielded as `GeocodedLocation.timed_out`.
+
+        Requests wait for rate limit slots in `lane` (see `lanes`).
+        '''
+        job_deadline = deadlines.after(deadline)
+
+        def make_coros(client):
+            return (
+                self._geocode_before_deadline(address, client, job_deadline, address_timeout)
+                for address in addresses
+            )
+
+        results = self._results_gen(make_coros, in_order, lane)
+        try:
+            async for result in results:
+                yield result
+        finally:
+            await results.aclose()
+
+    async def reverse_geocode_async_gen(self, points: List[Tuple[float, float]], in_order=True, deadline: Optional[float] = None, address_timeout: Optional[float] = None, lane: str = lanes.BULK) -> AsyncGenerator[GeocodedLocation, None]:
+        '''
+        Like `geocode_async_gen`, for (lat, lon) points. Each result's
+        `address` is the point as "lat,lon" and `geocode_address` the
+        address found there.
+        '''
+        job_deadline = deadlines.after(deadline)
+
+        def make_coros(client):
+            return (
+                self._before_deadline(reverse_query(lat, lon), partial(self.reverse_geocode_with_client, lat, lon, client), job_deadline, address_timeout)
+                for lat, lon in points
+            )
+
+        results = self._results_gen(make_coros, in_order, lane)
+        try:
+            async for result in results:
+                yield result
+        finally:
+            await results.aclose()
 
     @property
     def name(self):
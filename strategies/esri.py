@@ -1,21 +1,49 @@
 import asyncio
+from functools import partial
 from dotenv import load_dotenv
 import httpx
 import logging
 import os
+from typing import Tuple
 
+import deadlines
+import fast_json
+import profiling
 from strategies import abstract
-from common import BadAuthError, GeocodedLocation, GeocoderError, FailedGeocodeError
+from common import (
+    BadAuthError, GeocodedLocation, GeocoderError, FailedGeocodeError,
+    MATCH_LEVEL, MATCH_LEVEL_CONFIDENCE,
+)
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# https://developers.arcgis.com/rest/geocode/api-reference/geocoding-service-output.htm
+ADDR_TYPE_MATCH_LEVEL = {
+    'PointAddress': MATCH_LEVEL.ROOFTOP,
+    'Subaddress': MATCH_LEVEL.ROOFTOP,
+    'StreetAddress': MATCH_LEVEL.INTERPOLATED,
+    'StreetAddressExt': MATCH_LEVEL.INTERPOLATED,
+    'StreetInt': MATCH_LEVEL.STREET,
+    'StreetBetween': MATCH_LEVEL.STREET,
+    'StreetName': MATCH_LEVEL.STREET,
+    'Locality': MATCH_LEVEL.LOCALITY,
+    'PostalLoc': MATCH_LEVEL.LOCALITY,
+    'PostalExt': MATCH_LEVEL.LOCALITY,
+    'Postal': MATCH_LEVEL.LOCALITY,
+}
+
 
 class Geocoder(abstract.Geocoder):
+    provider = 'esri'
+    supports_reverse = True
     client_id = os.environ['ESRI_CLIENT_ID']
     client_secret = os.environ['ESRI_CLIENT_SECRET']
     token_url = 'https://www.arcgis.com/sharing/rest/oauth2/token'
     geocode_url = 'https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/findAddressCandidates'
+    reverse_url = 'https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/reverseGeocode'
+    # The token fetch warms up its own host.
+    warmup_urls = (geocode_url,)
 
     def __init__(self, rate_limit: int = 2):
         self.token = None
@@ -40,29 +68,40 @@ class Geocoder(abstract.Geocoder):
             resp = await client.post(
                 url=self.token_url,
                 params=await self._login_params(),
+                timeout=deadlines.timeout(self.request_timeout),
             )
 
-        body = resp.json()
+        body = fast_json.loads(resp.content)
         return body['access_token']
 
     async def _safe_get_token(self) -> None:
-        async with self.token_request_lock:
-            if not self.token:
-                self.token = await self._get_token()
+        with profiling.span('token'):
+            async with self.token_request_lock:
+                if not self.token:
+                    self.token = await self._get_token()
 
-    async def geocode_with_client(self, address: str, client) -> GeocodedLocation:
+    async def _prefetch(self) -> None:
+        await self._safe_get_token()
+
+    async def _with_token(self, call) -> GeocodedLocation:
         if not self.token:
             await self._safe_get_token()
 
         try:
-            geocoded_loc = await super().geocode_with_client(address, client)
+            geocoded_loc = await call()
         except BadAuthError as e:
             self.token = None
             await self._safe_get_token()
-            geocoded_loc = await super().geocode_with_client(address, client)
+            geocoded_loc = await call()
 
         return geocoded_loc
 
+    async def geocode_with_client(self, address: str, client) -> GeocodedLocation:
+        return await self._with_token(partial(super().geocode_with_client, address, client))
+
+    async def _reverse_lookup(self, lat: float, lon: float, client) -> GeocodedLocation:
+        return await self._with_token(partial(super()._reverse_lookup, lat, lon, client))
+
     async def _prepare_request(self, address: str) -> httpx.Request:
         return httpx.Request(
             method='GET',
@@ -71,11 +110,56 @@ class Geocoder(abstract.Geocoder):
                 'SingleLine': address, 
                 'f': 'json', 
                 'token': self.token,
-                "outFields": "address,location,Score,LongLabel,ShortLabel,Match_addr,postal",
+                # Only the best candidate and the fields we read, to keep
+                # responses small; address, location and score always come back.
+                "outFields": "Score,Addr_type",
+                "maxLocations": 1,
                 "forStorage": 0,
             }
         )
     
+    async def _prepare_reverse_request(self, lat: float, lon: float) -> httpx.Request:
+        return httpx.Request(
+            method='GET',
+            url=self.reverse_url,
+            params={
+                'location': f'{lon},{lat}',
+                'f': 'json',
+                'token': self.token,
+                "forStorage": 0,
+            }
+        )
+
+    async def _reverse_response_to_location(self, query: str, response_body: dict) -> GeocodedLocation:
+        if 'error' in response_body:
+            logger.error(f'[{self.name}]: Error reverse geocoding "{query}". Response: {response_body}')
+            code = response_body['error'].get('code')
+            if code == 400:
+                raise FailedGeocodeError()  # no address near the point
+            if code in {498, 499}:
+                raise BadAuthError()
+            raise GeocoderError()
+
+        try:
+            found = response_body['address']
+            loc = response_body['location']
+            lat = loc['y']
+            lon = loc['x']
+        except KeyError as e:
+            logger.error(f'[{self.name}]: Error reverse geocoding "{query}". Invalid response format: {response_body}. Error: {e}')
+            raise GeocoderError()
+
+        match_level = ADDR_TYPE_MATCH_LEVEL.get(found.get('Addr_type'), MATCH_LEVEL.APPROXIMATE)
+
+        return GeocodedLocation(
+            address=query,
+            lat=round(lat, 6),
+            lon=round(lon, 6),
+            geocode_address=found.get('LongLabel') or found.get('Match_addr', ''),
+            confidence=MATCH_LEVEL_CONFIDENCE[match_level],
+            match_level=match_level,
+        )
+
     async def _response_to_location(self, address: str, response_body: dict) -> GeocodedLocation:
         if ('error' in response_body) or ('candidates' not in response_body):
             logger.error(f'[{self.name}]: Error geocoding "{address}". Response: {response_body}')
@@ -97,9 +181,21 @@ class Geocoder(abstract.Geocoder):
             logger.error(f'[{self.name}]: Error geocoding address: "{address}". Invalid response format: {response_body}. Error: {e}')
             raise GeocoderError()
 
+        confidence, match_level = self._quality(first)
+
         return GeocodedLocation(
             address=address,
             lat=round(lat, 6),
             lon=round(lon, 6),
             geocode_address=first['address'],
+            confidence=confidence,
+            match_level=match_level,
         )
+
+    @staticmethod
+    def _quality(candidate: dict) -> Tuple[float, MATCH_LEVEL]:
+        attributes = candidate.get('attributes', {})
+        match_level = ADDR_TYPE_MATCH_LEVEL.get(attributes.get('Addr_type'), MATCH_LEVEL.APPROXIMATE)
+        score = candidate.get('score', attributes.get('Score', 0))
+        confidence = MATCH_LEVEL_CONFIDENCE[match_level] * score / 100
+        return round(confidence, 3), match_level
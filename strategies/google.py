@@ -8,10 +8,8 @@ import logging
 
 from strategies import abstract
 
-from common import GeocodedLocation
-
 from common import (
-    GeocodedLocation,
+    GeocodedLocation, MATCH_LEVEL, MATCH_LEVEL_CONFIDENCE,
     BadRequestError, GeocoderError, FailedGeocodeError, 
     BadAuthError, RateLimitError, ConnectionError, 
     ServerError,
@@ -48,9 +46,21 @@ class STATUS(str, Enum):
     UNKNOWN_ERROR = 'UNKNOWN_ERROR'
 
 
+LOCATION_TYPE_MATCH_LEVEL = {
+    'ROOFTOP': MATCH_LEVEL.ROOFTOP,
+    'RANGE_INTERPOLATED': MATCH_LEVEL.INTERPOLATED,
+    'GEOMETRIC_CENTER': MATCH_LEVEL.STREET,
+    'APPROXIMATE': MATCH_LEVEL.APPROXIMATE,
+}
+PARTIAL_MATCH_PENALTY = 0.7
+
+
 class Geocoder(abstract.Geocoder):
+    provider = 'google'
+    supports_reverse = True
     url = 'https://maps.googleapis.com/maps/api/geocode/json'
     key = os.environ['GOOGLE_API_KEY']
+    warmup_urls = (url,)
     
     async def _prepare_request(self, address: str) -> httpx.Request:
         return httpx.Request(
@@ -58,6 +68,17 @@ class Geocoder(abstract.Geocoder):
             url=self.url,
             params={'address': address, 'key': self.key}
         )
+
+    async def _prepare_reverse_request(self, lat: float, lon: float) -> httpx.Request:
+        return httpx.Request(
+            method='GET',
+            url=self.url,
+            params={'latlng': f'{lat},{lon}', 'key': self.key}
+        )
+
+    async def _reverse_response_to_location(self, query: str, response_body: dict) -> GeocodedLocation:
+        # Same response format as forward geocoding, results closest first.
+        return await self._response_to_location(query, response_body)
     
     async def _raise_for_status(self, address: str, response_body: dict) -> STATUS:
         status = response_body.get('status')
@@ -82,7 +103,7 @@ class Geocoder(abstract.Geocoder):
         else:
             raise GeocoderError()
 
-    async def _parse_response_body(self, address: str, response_body: dict) -> Tuple[float, float, str]:
+    async def _parse_response_body(self, address: str, response_body: dict) -> Tuple[float, float, str, dict]:
         try:
             results = response_body['results']
         except KeyError as e:
@@ -104,15 +125,27 @@ class Geocoder(abstract.Geocoder):
             logger.error(f'[{self.name}]: Error geocoding address: "{address}". Invalid response format: {response_body}. Error: {e}')
             raise GeocoderError()
         
-        return lat, lon, geocode_address
+        return lat, lon, geocode_address, first
+
+    @staticmethod
+    def _quality(result: dict) -> Tuple[float, MATCH_LEVEL]:
+        location_type = result.get('geometry', {}).get('location_type')
+        match_level = LOCATION_TYPE_MATCH_LEVEL.get(location_type, MATCH_LEVEL.APPROXIMATE)
+        confidence = MATCH_LEVEL_CONFIDENCE[match_level]
+        if result.get('partial_match'):
+            confidence *= PARTIAL_MATCH_PENALTY
+        return round(confidence, 3), match_level
 
     async def _response_to_location(self, address: str, response_body: dict) -> GeocodedLocation:
         await self._raise_for_status(address, response_body)
-        lat, lon, geocode_address = await self._parse_response_body(address, response_body)
-        
+        lat, lon, geocode_address, first = await self._parse_response_body(address, response_body)
+        confidence, match_level = self._quality(first)
+
         return GeocodedLocation(
             address=address,
             lat=round(lat, 6),
             lon=round(lon, 6),
             geocode_address=geocode_address,
+            confidence=confidence,
+            match_level=match_level,
         )
@@ -0,0 +1,129 @@
+import asyncio
+from functools import lru_cache
+import logging
+import os
+import threading
+
+from dotenv import load_dotenv
+
+from address_index import AddressIndex
+from fuzzy_index import FuzzyIndex
+from normalize import split_address
+from strategies import abstract
+from common import GeocodedLocation, FailedGeocodeError, MATCH_LEVEL, MATCH_LEVEL_CONFIDENCE
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+class SETTINGS:
+    # Fall back to approximate matching when there's no exact match.
+    fuzzy = True
+    fuzzy_min_score = 0.85
+    fuzzy_budget_ms = 20.0
+    fuzzy_candidates = 5
+    # The fuzzy index lives in each process's memory (about 300 bytes per
+    # key) and takes roughly 10 seconds per million keys to build, so it is
+    # turned off for bigger indexes: a full G-NAF would take gigabytes per
+    # worker and minutes on the first miss.
+    fuzzy_max_keys = 2_000_000
+
+
+@lru_cache(maxsize=None)
+def open_index(path: str) -> AddressIndex:
+    '''Every Geocoder in the process shares one mapping per index file.'''
+    return AddressIndex(path)
+
+
+@lru_cache(maxsize=None)
+def _build_fuzzy_index(path: str) -> FuzzyIndex:
+    return FuzzyIndex(key for key, *_ in open_index(path).items())
+
+
+_fuzzy_index_lock = threading.Lock()
+
+
+def open_fuzzy_index(path: str) -> FuzzyIndex:
+    '''
+    Built on first use, once even if several threads ask at the same time;
+    it holds every key in memory, unlike the mmap index (see
+    `SETTINGS.fuzzy_max_keys`).
+    '''
+    with _fuzzy_index_lock:
+        return _build_fuzzy_index(path)
+
+
+class Geocoder(abstract.Geocoder):
+    '''
+    Looks addresses up in a local address-point index (see `address_index`)
+    built from authoritative data such as G-NAF. There is no network call, so
+    lookups don't take a rate limit slot and answer in microseconds. Misses
+    raise FailedGeocodeError so a robust geocoder moves on to paid providers.
+
+    Addresses without an exact match are looked up approximately (typos,
+    variant spellings) and accepted if they score at least `fuzzy_min_score`,
+    for indexes of up to `fuzzy_max_keys` keys. Approximate lookups (and
+    building their index, on the first one) run in a worker thread, so they
+    don't hold up the event loop.
+
+    The index is configured with the LOCAL_GAZETTEER_PATH environment variable.
+    '''
+    provider = 'local'
+    index_path = os.environ.get('LOCAL_GAZETTEER_PATH')
+
+    def __init__(self, rate_limit: int = 2):
+        if not self.index_path:
+            raise ValueError(f'[{self.name}]: No index, set LOCAL_GAZETTEER_PATH')
+        self.index = open_index(self.index_path)
+        self.fuzzy = SETTINGS.fuzzy and len(self.index) <= SETTINGS.fuzzy_max_keys
+        if SETTINGS.fuzzy and not self.fuzzy:
+            logger.warning(f'[{self.name}]: Approximate matching is off, {len(self.index)} keys is over SETTINGS.fuzzy_max_keys ({SETTINGS.fuzzy_max_keys})')
+        super().__init__(rate_limit=rate_limit)
+
+    async def _prefetch(self) -> None:
+        # Building the fuzzy index is the slow part of the first miss.
+        if self.fuzzy:
+            await asyncio.to_thread(open_fuzzy_index, self.index_path)
+
+    async def _prepare_request(self, address: str): pass
+    async def _response_to_location(self, address: str, response): pass
+
+    def _fuzzy_lookup(self, address: str):
+        fuzzy_index = open_fuzzy_index(self.index_path)
+        house_number = split_address(address)[0]
+        matches = fuzzy_index.query(address, k=SETTINGS.fuzzy_candidates, budget_ms=SETTINGS.fuzzy_budget_ms)
+        for key_id, score in matches:
+            if score < SETTINGS.fuzzy_min_score:
+                break
+            # One edit away is often the house next door, which is not a match.
+            key = fuzzy_index.keys[key_id]
+            if split_address(key)[0] == house_number:
+                return self.index.get(key), score
+
+        return None, 0
+
+    async def _lookup(self, address: str) -> GeocodedLocation:
+        # Exact lookups take microseconds, so they stay on the event loop.
+        found, score = self.index.lookup(address), 1.0
+        if found is None and self.fuzzy:
+            found, score = await asyncio.to_thread(self._fuzzy_lookup, address)
+
+        if found is None:
+            logger.debug(f'[{self.name}]: No local match for "{address}"')
+            raise FailedGeocodeError()
+
+        lat, lon, geocode_address = found
+        return GeocodedLocation(
+            address=address,
+            lat=round(lat, 6),
+            lon=round(lon, 6),
+            geocode_address=geocode_address,
+            confidence=round(MATCH_LEVEL_CONFIDENCE[MATCH_LEVEL.ROOFTOP] * score, 3),
+            match_level=MATCH_LEVEL.ROOFTOP,
+        )
+
+    async def geocode(self, address: str) -> GeocodedLocation:
+        return await self._lookup(address)
+
+    async def geocode_with_client(self, address: str, client) -> GeocodedLocation:
+        return await self._lookup(address)
@@ -1,12 +1,15 @@
 import asyncio
 import logging
+import time
 from typing import Generator
 from dotenv import load_dotenv
 
-from strategies import abstract, google, esri
+from strategies import abstract, google, esri, local
 
 
-from common import GeocodedLocation, GeocoderError
+import deadlines
+import profiling
+from common import GeocodedLocation, GeocoderError, FailedGeocodeError, DeadlineExceededError
 
 load_dotenv()
 
@@ -14,33 +17,90 @@ logger = logging.getLogger(__name__)
 
 class SETTINGS:
     simultaneous_requests = 2
+    # Results at or above this confidence are accepted without asking
+    # the next provider for a second opinion.
+    accept_confidence = 0.8
 
 class Geocoder(abstract.Geocoder):
     '''
     A geocoder that uses multiple geocoders to geocode addresses.
-    If the first geocoder fails, it tries the next one.
+    If the first geocoder fails, or its answer is below `accept_confidence`,
+    it tries the next one and keeps the most confident answer.
+
+    Under a deadline, the best answer so far is returned once time runs out.
+
+    When a local gazetteer is configured it is tried first, so only
+    addresses it doesn't know cost a provider request.
     '''
-    def __init__(self, rate_limit: int = 2):
-        self.google = google.Geocoder(rate_limit=rate_limit)
-        self.esri = esri.Geocoder(rate_limit=rate_limit)
+    supports_reverse = True
+    Providers = ([local.Geocoder] if local.Geocoder.index_path else []) + [google.Geocoder, esri.Geocoder]
+
+    def __init__(self, rate_limit: int = 2, accept_confidence: float = SETTINGS.accept_confidence):
+        self.providers = [Provider(rate_limit=rate_limit) for Provider in self.Providers]
+        self.accept_confidence = accept_confidence
         super().__init__(rate_limit=rate_limit)
 
+    async def warmup(self, client, connections: int = 2) -> abstract.WarmupReport:
+        '''Warms up every provider at once.'''
+        started = time.perf_counter()
+        providers = await asyncio.gather(*(provider.warmup(client, connections) for provider in self.providers))
+        report = abstract.WarmupReport(
+            self.name,
+            seconds=time.perf_counter() - started,
+            connections=sum(p.connections for p in providers),
+            providers=list(providers),
+        )
+        logger.info(f'[{self.name}]: Warmed up in {report.seconds:.3f}s ({report.connections} connections)')
+        return report
+
     async def _prepare_request(self, address: str): pass
     async def _response_to_location(self, address: str, response):  pass
 
+    async def _best_of(self, query: str, providers, call, strict: bool = False) -> GeocodedLocation:
+        '''
+        The most confident answer from `providers`, or null_island if none
+        has one. With `strict`, no answer raises instead (see `_geocode_or_raise`).
+        '''
+        best = None
+        errors = []
+        for i, provider in enumerate(providers):
+            stage = provider.provider or provider.name
+            try:
+                with profiling.span(f'fallback:{stage}' if i else stage):
+                    loc = await call(provider)
+            except DeadlineExceededError:
+                break
+            except GeocoderError as e:
+                errors.append(e)
+                if deadlines.expired():
+                    break
+                continue
+
+            if best is None or loc.confidence > best.confidence:
+                best = loc
+            if best.confidence >= self.accept_confidence:
+                break
+            logger.debug(f'[{self.name}]: Low confidence ({loc.confidence}) from [{provider.name}] for "{query}"')
+
+        if best is None and deadlines.expired():
+            raise DeadlineExceededError()
+        if best is None and strict:
+            # It only definitely doesn't geocode if every provider said so.
+            raise next((e for e in errors if not isinstance(e, FailedGeocodeError)), FailedGeocodeError())
+        return best or GeocodedLocation.null_island(query)
+
     async def geocode_with_client(self, address: str, client) -> GeocodedLocation:
-        try:
-            loc = await self.google.geocode_with_client(address, client)
-            return loc
-        except GeocoderError:
-            pass
-        
-        try:
-            return await self.esri.geocode_with_client(address, client)
-        except GeocoderError:
-            pass
-
-        return GeocodedLocation.null_island(address)
+        return await self._best_of(address, self.providers, lambda provider: provider.geocode_with_client(address, client))
+
+    async def _geocode_or_raise(self, address: str, client) -> GeocodedLocation:
+        return await self._best_of(address, self.providers, lambda provider: provider._geocode_or_raise(address, client), strict=True)
+
+    async def _reverse_lookup(self, lat: float, lon: float, client) -> GeocodedLocation:
+        providers = [provider for provider in self.providers if provider.supports_reverse]
+        return await self._best_of(
+            abstract.reverse_query(lat, lon), providers,
+            lambda provider: provider.reverse_geocode_with_client(lat, lon, client),
+        )
 
 
 # from queue import Queue
@@ -1,8 +1,11 @@
-from typing import Generator, Any, Type
+from typing import Generator, Any, List, Optional, Tuple, Type
 from queue import Queue
 import threading
 import asyncio
 
+import delta
+import lanes
+import profiling
 import protocols
 from strategies import robust
 
@@ -13,34 +16,76 @@ class GeocodeStreamerQueue:
     '''
     DONE = object()  # sentinel to indicate geocoding finished.
 
-    def __init__(self, rate_limit=2, Geocoder: Type[protocols.BulkAsyncGeocoder] = robust.Geocoder):
+    def __init__(self, rate_limit=2, Geocoder: Type[protocols.BulkAsyncGeocoder] = robust.Geocoder, warmup_connections: int = 0):
         self.Geocoder = Geocoder
         self.rate_limit = rate_limit
+        # Connections to open to each provider alongside a run's first requests.
+        self.warmup_connections = warmup_connections
+        self.timed_out: List[str] = []  # addresses that ran out of time in the last run
+        self.warmup_report = None  # how long the last run's warm up took
     
-    async def _geocode_to_queue(self, addresses, in_order, result_queue):
+    async def _geocode_to_queue(self, make_async_gen, result_queue):
         geocoder = self.Geocoder(rate_limit=self.rate_limit)
-        async for result in geocoder.geocode_async_gen(addresses, in_order):
+        geocoder.warmup_connections = self.warmup_connections
+        self.timed_out = geocoder.timed_out
+        async for result in make_async_gen(geocoder):
             result_queue.put(result)
+        self.warmup_report = geocoder.warmup_report
 
-    def _geocode_to_queue_in_async_loop(self, addresses, in_order, result_queue):
+    def _geocode_to_queue_in_async_loop(self, make_async_gen, result_queue):
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         try:
-            loop.run_until_complete(self._geocode_to_queue(addresses, in_order, result_queue))
+            loop.run_until_complete(self._geocode_to_queue(make_async_gen, result_queue))
         finally:
+            loop.close()
             result_queue.put(self.DONE)
 
-    def geocode_gen(self, addresses: list, in_order=True) -> Generator[Any, None, None]:
+    def _stream(self, make_async_gen) -> Generator[Any, None, None]:
         result_queue = Queue()
-        thread = threading.Thread(target=self._geocode_to_queue_in_async_loop, args=(addresses, in_order, result_queue))
+        thread = threading.Thread(target=self._geocode_to_queue_in_async_loop, args=(make_async_gen, result_queue))
         thread.start()
 
         while True:
-            next_result = result_queue.get(block=True)
+            with profiling.span('queue_wait'):
+                next_result = result_queue.get(block=True)
             if next_result is self.DONE:
                 break
             yield next_result
 
+    def geocode_gen(self, addresses: list, in_order=True, deadline: Optional[float] = None, address_timeout: Optional[float] = None, lane: str = lanes.BULK) -> Generator[Any, None, None]:
+        '''
+        `deadline` is a time budget in seconds for the whole batch and
+        `address_timeout` one for each address. Addresses that don't make it
+        are yielded as `GeocodedLocation.timed_out` and listed in `timed_out`.
+
+        `lane` is the priority class the batch's requests queue in; use
+        `lanes.INTERACTIVE` for user-facing lookups so they aren't stuck
+        behind bulk jobs sharing the same provider quota.
+        '''
+        yield from self._stream(
+            lambda geocoder: geocoder.geocode_async_gen(addresses, in_order, deadline, address_timeout, lane)
+        )
+
+    def reverse_geocode_gen(self, points: List[Tuple[float, float]], in_order=True, deadline: Optional[float] = None, address_timeout: Optional[float] = None, lane: str = lanes.BULK) -> Generator[Any, None, None]:
+        '''
+        Reverse geocode (lat, lon) points, with the same options as
+        `geocode_gen`. Nearby points share one lookup (see
+        `Geocoder.reverse_precision`), and cells already answered in this
+        process aren't looked up again (see `Geocoder.reverse_results`).
+        '''
+        yield from self._stream(
+            lambda geocoder: geocoder.reverse_geocode_async_gen(points, in_order, deadline, address_timeout, lane)
+        )
+
+    def geocode_delta_gen(self, addresses: list, previous: Optional[delta.Previous] = None, ttl: Optional[float] = None, output: Optional[str] = None, **geocode_kwargs) -> Generator[Any, None, None]:
+        '''
+        Like `geocode_gen`, always in order, but reusing results from a
+        previous run (a file written via `output`, or a mapping) for
+        addresses that haven't changed. See `delta`.
+        '''
+        yield from delta.geocode_delta_gen(self, addresses, previous, ttl, output, **geocode_kwargs)
+
 
 class GeocoderStreamerAsync:
     '''
@@ -60,19 +105,32 @@ class GeocoderStreamerAsync:
     def __init__(self, rate_limit=2, Geocoder: Type[protocols.BulkAsyncGeocoder] = robust.Geocoder):
         self.Geocoder = Geocoder
         self.rate_limit = rate_limit
+        self.timed_out: List[str] = []
 
-    async def run_async_gen(self, addresses, in_order):
-        async for result in self.Geocoder(rate_limit=self.rate_limit).geocode_async_gen(addresses, in_order):
-            yield result
+    async def run_async_gen(self, addresses, in_order, deadline=None, address_timeout=None, lane=lanes.BULK):
+        geocoder = self.Geocoder(rate_limit=self.rate_limit)
+        self.timed_out = geocoder.timed_out
+        results = geocoder.geocode_async_gen(addresses, in_order, deadline, address_timeout, lane)
+        try:
+            async for result in results:
+                yield result
+        finally:
+            await results.aclose()
 
-    def geocode_gen(self, addresses: list, in_order=True) -> Generator[Any, None, None]:
-        gen = self.run_async_gen(addresses, in_order) 
+    def geocode_gen(self, addresses: list, in_order=True, deadline: Optional[float] = None, address_timeout: Optional[float] = None, lane: str = lanes.BULK) -> Generator[Any, None, None]:
+        gen = self.run_async_gen(addresses, in_order, deadline, address_timeout, lane) 
 
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        while True:
-            try:
-                next_result = loop.run_until_complete(gen.__anext__())
-                yield next_result
-            except StopAsyncIteration:
-                break
+        try:
+            while True:
+                try:
+                    next_result = loop.run_until_complete(gen.__anext__())
+                    yield next_result
+                except StopAsyncIteration:
+                    break
+        finally:
+            # If the caller stopped reading early, this cancels the requests
+            # still running so they give back their rate limit slots.
+            loop.run_until_complete(gen.aclose())
+            loop.close()
@@ -1,13 +1,34 @@
 
 import asyncio
+from collections import Counter
+import copy
 import json
+import os
+import time
 import httpx
-from common import GeocodedLocation
+import pytest
+from common import GeocodedLocation, FailedGeocodeError, MATCH_LEVEL, NotSupportedError
 
-from strategies import esri, google, robust
+from strategies import abstract, esri, google, local, robust
+from address_index import build_index
+from fuzzy_index import FuzzyIndex
+from normalize import normalize_address
+import lanes
+import profiling
+import result_cache
+from lanes import PriorityLimiter
+import dataframes
+import delta
+import fast_json
+from coordination import Coordinator, InProcessBackend, SQLiteBackend
+from client import GeocoderClient
 from stream import GeocodeStreamerQueue, GeocoderStreamerAsync
+from spatial import SpatialResultStore
+import scheduling
+from scheduling import make_locality_geocoder
 
 from example_addresses import addresses
+import mock_geocoders
 from mock_geocoders import make_mock_geocoder
 
 # Set REQUEST_DURATION to zero for the purpose of testing, but you 
@@ -45,3 +66,559 @@ def test_google_geocoder():
     for result in streamer.geocode_gen(TEST_ADDRESSES, in_order=True):
         assert isinstance(result, GeocodedLocation)
 
+
+def test_spatial_result_store():
+    Geocoder = make_mock_geocoder(robust.Geocoder, REQUEST_DURATION)
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder)
+    store = SpatialResultStore()
+    results = list(store.record(streamer.geocode_gen(TEST_ADDRESSES, in_order=True)))
+    store.add(GeocodedLocation.null_island('nowhere'))
+
+    assert len(results) == len(TEST_ADDRESSES)
+    assert len(store.within_radius(-31.73375, 115.72875, metres=50)) == len(TEST_ADDRESSES)
+    assert store.within_radius(-31.8, 115.8, metres=50) == []
+    assert len(store.within_bbox(-32, 115, -31, 116)) == len(TEST_ADDRESSES)
+    assert [len(locs) for locs in store.duplicates().values()] == [len(TEST_ADDRESSES)]
+    assert [loc.address for loc in store.null_island] == ['nowhere']
+
+
+def test_robust_geocoder_early_accepts_confident_result():
+    Geocoder = make_mock_geocoder(robust.Geocoder, REQUEST_DURATION)
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder)
+    for result in streamer.geocode_gen(TEST_ADDRESSES, in_order=True):
+        assert result.geocode_address == mock_geocoders.GOOGLE_GEOCODE_RESP_MSG['results'][0]['formatted_address']
+        assert result.match_level == MATCH_LEVEL.ROOFTOP
+        assert result.confidence == 1.0
+
+
+def test_robust_geocoder_falls_through_low_confidence_result(monkeypatch):
+    approximate = copy.deepcopy(mock_geocoders.GOOGLE_GEOCODE_RESP_MSG)
+    approximate['results'][0]['geometry']['location_type'] = 'APPROXIMATE'
+    approximate['results'][0]['partial_match'] = True
+    monkeypatch.setattr(mock_geocoders, 'GOOGLE_GEOCODE_RESP_MSG', approximate)
+
+    Geocoder = make_mock_geocoder(robust.Geocoder, REQUEST_DURATION)
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder)
+    results = list(streamer.geocode_gen(TEST_ADDRESSES, in_order=True))
+    assert len(results) == len(TEST_ADDRESSES)
+    for result in results:
+        assert result.geocode_address == mock_geocoders.ESRI_GEOCODE_RESP_MSG['candidates'][0]['address']
+        assert result.match_level == MATCH_LEVEL.ROOFTOP
+
+
+def test_locality_geocoder_interpolates_between_representatives(monkeypatch):
+    monkeypatch.setattr(mock_geocoders, 'REQUEST_COUNTS', Counter())
+    street = [a for a in addresses if 'ACHILLES LOOP' in a]
+    Geocoder = make_locality_geocoder(make_mock_geocoder(robust.Geocoder, REQUEST_DURATION), approximate=True)
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder)
+    results = list(streamer.geocode_gen(street + street[:3], in_order=True))
+
+    assert [r.address for r in results] == street + street[:3]
+    # Lowest and highest on each side of the street, plus 'LOT/1589' which has no house number.
+    assert mock_geocoders.REQUEST_COUNTS[google.Geocoder.url] == 5
+    assert sum(r.match_level == MATCH_LEVEL.INTERPOLATED for r in results) == len(street) - 5 + 1  # the repeated '4' is interpolated too
+
+
+def test_locality_geocoder_skips_locality_that_does_not_geocode(monkeypatch):
+    monkeypatch.setattr(mock_geocoders, 'REQUEST_COUNTS', Counter())
+    monkeypatch.setattr(mock_geocoders, 'GOOGLE_GEOCODE_RESP_MSG', {'results': [], 'status': 'ZERO_RESULTS'})
+    monkeypatch.setattr(mock_geocoders, 'ESRI_GEOCODE_RESP_MSG', {'candidates': []})
+    Geocoder = make_locality_geocoder(make_mock_geocoder(robust.Geocoder, REQUEST_DURATION))
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder)
+    results = list(streamer.geocode_gen(addresses[:20], in_order=False))
+
+    assert sorted(r.address for r in results) == sorted(addresses[:20])
+    assert all(r.is_null_island for r in results)
+    assert mock_geocoders.REQUEST_COUNTS[google.Geocoder.url] == scheduling.SETTINGS.min_locality_probes
+
+
+def test_concurrent_locality_geocoder_calls_keep_their_own_deadlines():
+    geocoder = make_locality_geocoder(make_mock_geocoder(google.Geocoder, 0.1))(rate_limit=RATE_LIMIT)
+
+    async def collect(**kwargs):
+        return [loc async for loc in geocoder.geocode_async_gen(TEST_ADDRESSES, **kwargs)]
+
+    async def both():
+        return await asyncio.gather(collect(deadline=0.05), collect())
+
+    hurried, patient = asyncio.run(both())
+    assert all(loc.is_null_island for loc in hurried)
+    assert not any(loc.is_null_island for loc in patient)
+
+
+def test_locality_geocoder_does_not_write_off_locality_on_transient_errors(monkeypatch):
+    monkeypatch.setattr(mock_geocoders, 'REQUEST_COUNTS', Counter())
+    monkeypatch.setattr(mock_geocoders, 'STATUS_CODES', {google.Geocoder.url: 503, esri.Geocoder.geocode_url: 503})
+    Geocoder = make_locality_geocoder(make_mock_geocoder(robust.Geocoder, REQUEST_DURATION))
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder)
+    results = list(streamer.geocode_gen(addresses[:20], in_order=False))
+
+    assert all(r.is_null_island for r in results)
+    # Every address was still tried, since a 503 says nothing about the locality.
+    assert mock_geocoders.REQUEST_COUNTS[google.Geocoder.url] == len({normalize_address(a) for a in addresses[:20]})
+
+
+def test_local_geocoder_is_tier_zero_for_robust(tmp_path, monkeypatch):
+    monkeypatch.setattr(mock_geocoders, 'REQUEST_COUNTS', Counter())
+    index_path = str(tmp_path / 'gazetteer.idx')
+    build_index([(TEST_ADDRESSES[0], -31.7, 115.7), ('3 Achilles Lp., Iluka WA', -31.8, 115.8)], index_path)
+
+    monkeypatch.setattr(local.Geocoder, 'index_path', index_path)
+
+    class Geocoder(robust.Geocoder):
+        Providers = [local.Geocoder, google.Geocoder, esri.Geocoder]
+
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=make_mock_geocoder(Geocoder, REQUEST_DURATION))
+    results = list(streamer.geocode_gen(TEST_ADDRESSES, in_order=True))
+
+    assert [(r.lat, r.lon) for r in results[:2]] == [(-31.7, 115.7), (-31.8, 115.8)]
+    assert results[1].geocode_address == '3 Achilles Lp., Iluka WA'
+    assert mock_geocoders.REQUEST_COUNTS[google.Geocoder.url] == len(TEST_ADDRESSES) - 2
+
+
+def test_fuzzy_index_finds_typos():
+    index = FuzzyIndex(normalize_address(address) for address in addresses)
+    typos = ['2 ACHILLIES LOOP, ILUKA, WA', '3 ACHILES LOOP ILUKA WA 6028', '1731 ACHILLES LOOP, ILUKA']
+
+    single = [index.query(typo, k=3, budget_ms=1000) for typo in typos]
+    assert [index.keys[matches[0][0]] for matches in single] == [
+        '2 ACHILLES LOOP ILUKA WA', '3 ACHILLES LOOP ILUKA WA', '1731 ACHILLES LOOP ILUKA WA',
+    ]
+    assert all(0.8 < matches[0][1] < 1 for matches in single)
+    assert index.query_many(typos + [typos[0].lower()], k=3, budget_ms=1000) == single + single[:1]
+
+
+def test_fuzzy_query_budget_covers_candidate_generation(monkeypatch):
+    keys = [f'{n} SOME STREET SUBURB WA' for n in range(200000)]
+    index = FuzzyIndex(keys)
+    monkeypatch.setattr(index, 'max_posting', len(keys))  # every trigram counts
+
+    start = time.perf_counter()
+    index.query('12345 SOME STRET SUBURB WA', budget_ms=20)
+    assert time.perf_counter() - start < 0.1
+
+
+def test_local_geocoder_fuzzy_match(tmp_path, monkeypatch):
+    index_path = str(tmp_path / 'gazetteer.idx')
+    build_index(((address, -31.7, 115.7) for address in addresses), index_path)
+    monkeypatch.setattr(local.Geocoder, 'index_path', index_path)
+
+    loc = asyncio.run(local.Geocoder().geocode('2 ACHILLIES LOOP, ILUKA, WA'))
+    assert loc.geocode_address == addresses[0]
+    assert 0.85 <= loc.confidence < 1
+
+    monkeypatch.setattr(local.SETTINGS, 'fuzzy_max_keys', 10)
+    with pytest.raises(FailedGeocodeError):
+        asyncio.run(local.Geocoder().geocode('2 ACHILLIES LOOP, ILUKA, WA'))
+
+
+def test_local_fuzzy_lookup_does_not_block_event_loop(tmp_path, monkeypatch):
+    index_path = str(tmp_path / 'gazetteer.idx')
+    build_index(((address, -31.7, 115.7) for address in addresses), index_path)
+    monkeypatch.setattr(local.Geocoder, 'index_path', index_path)
+    open_fuzzy_index = local.open_fuzzy_index
+    monkeypatch.setattr(local, 'open_fuzzy_index', lambda path: time.sleep(0.3) or open_fuzzy_index(path))
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        loc = await local.Geocoder().geocode('2 ACHILLIES LOOP, ILUKA, WA')
+        ticker.cancel()
+        return loc, ticks
+
+    loc, ticks = asyncio.run(run())
+    assert loc.geocode_address == addresses[0]
+    assert ticks >= 10
+
+
+def test_deadline_times_out_hung_requests():
+    Geocoder = make_mock_geocoder(robust.Geocoder, request_duration=10)
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder)
+
+    start = time.monotonic()
+    results = list(streamer.geocode_gen(TEST_ADDRESSES, in_order=True, deadline=0.2))
+
+    assert time.monotonic() - start < 2
+    assert [r.address for r in results] == TEST_ADDRESSES
+    assert all(r.is_null_island and r.geocode_address == 'Timed out' for r in results)
+    assert sorted(streamer.timed_out) == sorted(TEST_ADDRESSES)
+
+
+def test_address_timeout_leaves_fast_addresses_alone():
+    Geocoder = make_mock_geocoder(google.Geocoder, REQUEST_DURATION)
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder)
+    results = list(streamer.geocode_gen(TEST_ADDRESSES, in_order=False, address_timeout=5))
+
+    assert len(results) == len(TEST_ADDRESSES)
+    assert not any(r.is_null_island for r in results)
+    assert streamer.timed_out == []
+
+
+def test_priority_limiter_lets_interactive_jump_bulk_backlog():
+    async def run():
+        limiter = PriorityLimiter(capacity=1)
+        order = []
+
+        async def work(lane, name):
+            await limiter.acquire(lane)
+            order.append(name)
+            await asyncio.sleep(0)
+            limiter.release()
+
+        await limiter.acquire(lanes.BULK)
+        tasks = [asyncio.create_task(work(lanes.BULK, f'bulk{i}')) for i in range(5)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(work(lanes.INTERACTIVE, 'interactive')))
+        await asyncio.sleep(0)
+        assert limiter.stats()[lanes.BULK].waiting == 5
+        limiter.release()
+        await asyncio.gather(*tasks)
+        return order, limiter.stats()
+
+    order, stats = asyncio.run(run())
+    assert order[0] == 'interactive'
+    assert sorted(order[1:]) == [f'bulk{i}' for i in range(5)]
+    assert stats[lanes.BULK].granted == 6 and stats[lanes.BULK].waiting == 0
+    assert stats[lanes.INTERACTIVE].granted == 1
+
+
+def test_priority_limiter_reclaims_slots_from_closed_loops():
+    limiter = PriorityLimiter(capacity=1)
+    dead = asyncio.new_event_loop()
+    dead.run_until_complete(limiter.acquire(lanes.BULK))  # holds the only slot
+    dead.create_task(limiter.acquire(lanes.BULK))
+    dead.run_until_complete(asyncio.sleep(0))  # and has a waiter parked
+    dead.close()
+
+    async def later():
+        await asyncio.wait_for(limiter.acquire(lanes.BULK), 1)
+        limiter.release()
+
+    asyncio.run(later())
+    assert limiter.stats()[lanes.BULK].waiting == 0
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_shared_limiters_are_reset_in_a_forked_child():
+    limiter = lanes.shared_limiter('fork-test', 1)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(limiter.acquire())  # held by a loop that stays in the parent
+
+    with limiter._lock:  # as if another thread were inside the limiter
+        pid = os.fork()
+    if pid == 0:
+        async def acquire():
+            await asyncio.wait_for(limiter.acquire(), 1)
+            limiter.release()
+        try:
+            asyncio.run(acquire())
+        finally:
+            os._exit(0 if limiter._available == 1 else 1)
+
+    _, status = os.waitpid(pid, 0)
+    loop.close()
+    assert os.waitstatus_to_exitcode(status) == 0
+
+
+def test_shared_limiter_grows_to_the_largest_rate_limit():
+    assert lanes.shared_limiter('test-provider', 2).capacity == 2
+    assert lanes.shared_limiter('test-provider', 1).capacity == 2  # doesn't throttle running streams
+    assert lanes.shared_limiter('test-provider', 5).capacity == 5
+    assert lanes.configure('test-provider', 3).capacity == 3
+
+
+def test_abandoned_stream_gives_back_its_slots():
+    limiter = lanes.shared_limiter('google', RATE_LIMIT)
+    gen = GeocoderStreamerAsync(rate_limit=RATE_LIMIT, Geocoder=make_mock_geocoder(google.Geocoder, 0.2)).geocode_gen(addresses[:10], in_order=True)
+    next(gen)
+    gen.close()
+    assert not limiter._held
+
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=make_mock_geocoder(google.Geocoder, REQUEST_DURATION))
+    results = list(streamer.geocode_gen(TEST_ADDRESSES, deadline=2))
+    assert not any(r.is_null_island for r in results)
+
+
+@pytest.mark.parametrize('make_backend', [lambda tmp_path: InProcessBackend(), lambda tmp_path: SQLiteBackend(str(tmp_path / 'coordination.db'))])
+def test_coordination_backends_pace_reservations(tmp_path, make_backend):
+    backend = make_backend(tmp_path)
+    waits = [backend.reserve_token('rate', rate=100, burst=2) for _ in range(6)]
+
+    assert waits[:2] == [0, 0]
+    assert waits[2:] == pytest.approx([0.01, 0.02, 0.03, 0.04], abs=0.005)
+
+
+def test_coordinator_shares_cached_results(tmp_path, monkeypatch):
+    monkeypatch.setattr(mock_geocoders, 'REQUEST_COUNTS', Counter())
+    coordinator = Coordinator(SQLiteBackend(str(tmp_path / 'coordination.db')), rates={'google': 1000})
+    monkeypatch.setattr(abstract.Geocoder, 'coordinator', coordinator)
+
+    Geocoder = make_mock_geocoder(robust.Geocoder, REQUEST_DURATION)
+    first = list(GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder).geocode_gen(TEST_ADDRESSES))
+    second = list(GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder).geocode_gen(TEST_ADDRESSES))
+
+    assert first == second
+    assert mock_geocoders.REQUEST_COUNTS[google.Geocoder.url] == len(TEST_ADDRESSES)
+
+
+def test_fast_json_decodes_response_bytes():
+    content = json.dumps(mock_geocoders.GOOGLE_GEOCODE_RESP_MSG).encode('utf-8')
+    assert fast_json.loads(content) == mock_geocoders.GOOGLE_GEOCODE_RESP_MSG
+    with pytest.raises(fast_json.DecodeError):
+        fast_json.loads(b'<html>Bad Gateway</html>')
+
+
+@pytest.mark.parametrize('limit', [{'deadline': 0.3}, {'address_timeout': 0.3}])
+def test_robust_geocoder_returns_its_best_answer_when_time_runs_out(monkeypatch, limit):
+    approximate = copy.deepcopy(mock_geocoders.GOOGLE_GEOCODE_RESP_MSG)
+    approximate['results'][0]['geometry']['location_type'] = 'APPROXIMATE'
+    monkeypatch.setattr(mock_geocoders, 'GOOGLE_GEOCODE_RESP_MSG', approximate)
+    monkeypatch.setitem(mock_geocoders.REQUEST_DURATIONS, esri.Geocoder.geocode_url, 10)
+
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=make_mock_geocoder(robust.Geocoder, REQUEST_DURATION))
+    started = time.perf_counter()
+    results = list(streamer.geocode_gen(TEST_ADDRESSES[:1], **limit))
+
+    assert results[0].geocode_address == approximate['results'][0]['formatted_address']
+    assert time.perf_counter() - started < 0.3 + robust.Geocoder.deadline_slack
+    assert streamer.timed_out == []
+
+
+def test_reverse_geocoding_shares_lookups_between_nearby_points(monkeypatch):
+    monkeypatch.setattr(mock_geocoders, 'REQUEST_COUNTS', Counter())
+    pings = [(-31.73372 + i * 1e-6, 115.72872 - i * 1e-6) for i in range(20)] + [(-31.8, 115.8)]
+
+    Geocoder = make_mock_geocoder(robust.Geocoder, REQUEST_DURATION)
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder)
+    results = list(streamer.reverse_geocode_gen(pings, in_order=True))
+
+    assert [r.address for r in results] == [f'{lat},{lon}' for lat, lon in pings]
+    assert all(r.geocode_address == mock_geocoders.GOOGLE_GEOCODE_RESP_MSG['results'][0]['formatted_address'] for r in results)
+    assert mock_geocoders.REQUEST_COUNTS[google.Geocoder.url] == 2
+
+    # A later batch reuses the cells already answered.
+    assert list(streamer.reverse_geocode_gen(pings, in_order=True)) == results
+    assert mock_geocoders.REQUEST_COUNTS[google.Geocoder.url] == 2
+
+
+def test_recent_results_keep_the_most_recently_used():
+    recent = abstract.RecentResults(2)
+    a, b, c = (GeocodedLocation.null_island(address) for address in addresses[:3])
+    recent.put('a', a)
+    recent.put('b', b)
+    recent.get('a')
+    recent.put('c', c)
+    assert (recent.get('a'), recent.get('b'), recent.get('c'), len(recent)) == (a, None, c, 2)
+
+
+def test_reverse_geocoding_falls_back_to_esri(monkeypatch):
+    monkeypatch.setattr(mock_geocoders, 'GOOGLE_GEOCODE_RESP_MSG', {'results': [], 'status': 'ZERO_RESULTS'})
+    Geocoder = make_mock_geocoder(robust.Geocoder, REQUEST_DURATION)
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder)
+    results = list(streamer.reverse_geocode_gen([(-31.73375, 115.72875)]))
+
+    assert results[0].geocode_address == mock_geocoders.ESRI_REVERSE_RESP_MSG['address']['LongLabel']
+    assert results[0].match_level == MATCH_LEVEL.ROOFTOP
+
+
+def test_unsupported_reverse_geocoding_raises_a_geocoder_error_and_isnt_kept():
+    class Geocoder(make_mock_geocoder(google.Geocoder, REQUEST_DURATION)):
+        _prepare_reverse_request = abstract.Geocoder._prepare_reverse_request
+
+    async def reverse():
+        geocoder = Geocoder(rate_limit=RATE_LIMIT)
+        async with geocoder.RequestClient() as client:
+            with pytest.raises(NotSupportedError):
+                await geocoder.reverse_geocode_with_client(-31.73375, 115.72875, client)
+        return geocoder._reverse_lookups
+
+    assert asyncio.run(reverse()) == {}
+
+
+def test_delta_geocoding_only_geocodes_changed_rows(tmp_path, monkeypatch):
+    Geocoder = make_mock_geocoder(robust.Geocoder, REQUEST_DURATION)
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder)
+    yesterday, today = str(tmp_path / 'yesterday.jsonl'), str(tmp_path / 'today.jsonl')
+    first = list(streamer.geocode_delta_gen(addresses[:10], previous=yesterday, output=yesterday))
+
+    monkeypatch.setattr(mock_geocoders, 'REQUEST_COUNTS', Counter())
+    changed = addresses[:8] + addresses[20:23] + [addresses[0].lower()]
+    second = list(streamer.geocode_delta_gen(changed, previous=yesterday, output=today))
+
+    assert [r.address for r in second] == changed
+    assert second[:8] == first[:8]
+    assert mock_geocoders.REQUEST_COUNTS[google.Geocoder.url] == 3  # the lower-cased repeat normalizes to a known row
+    assert len(delta.read_results(today)) == 11
+
+    monkeypatch.setattr(mock_geocoders, 'REQUEST_COUNTS', Counter())
+    list(streamer.geocode_delta_gen(changed, previous=today, ttl=-1))
+    assert mock_geocoders.REQUEST_COUNTS[google.Geocoder.url] == 11
+
+    # A run that stops early leaves the previous output alone.
+    gen = streamer.geocode_delta_gen(changed, previous=today, output=today, ttl=-1)
+    next(gen), next(gen)
+    gen.close()
+    assert len(delta.read_results(today)) == 11
+    assert not os.path.exists(f'{today}.tmp')
+
+
+def test_client_close_cancels_pending_lookups():
+    limiter = lanes.shared_limiter('google', RATE_LIMIT)
+    client = GeocoderClient(rate_limit=RATE_LIMIT, Geocoder=make_mock_geocoder(google.Geocoder, 0.2))
+    batch = client.submit_many(addresses[:20])
+    time.sleep(0.05)
+    client.close()
+
+    assert batch.cancelled()
+    assert not limiter._held
+    assert limiter.stats()[lanes.BULK].waiting == 0
+
+
+def test_client_doesnt_share_a_batch_deadline_with_other_calls():
+    with GeocoderClient(rate_limit=RATE_LIMIT, Geocoder=make_mock_geocoder(google.Geocoder, 0.2)) as client:
+        batch = client.submit_many(addresses[:1], deadline=0.05)
+        single = client.submit(addresses[0])
+        assert batch.result()[0].is_null_island
+        assert not single.result().is_null_island
+
+
+def test_client_is_shared_between_threads(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    monkeypatch.setattr(mock_geocoders, 'REQUEST_COUNTS', Counter())
+    Geocoder = make_mock_geocoder(google.Geocoder, REQUEST_DURATION)
+    batch = addresses[:10]
+
+    with GeocoderClient(rate_limit=RATE_LIMIT, Geocoder=Geocoder) as client:
+        with ThreadPoolExecutor(8) as pool:
+            batches = list(pool.map(client.geocode_many, [batch] * 8))
+        single = client.submit(batch[0]).result()
+
+    assert all([r.address for r in results] == batch for results in batches)
+    assert single == batches[0][0]
+    # Every thread went through one geocoder; concurrent duplicates share a lookup.
+    assert mock_geocoders.REQUEST_COUNTS[google.Geocoder.url] < 8 * len(batch)
+
+
+def test_geocode_frame_dedupes_and_aligns_to_index(monkeypatch):
+    pd = pytest.importorskip('pandas')
+    monkeypatch.setattr(mock_geocoders, 'REQUEST_COUNTS', Counter())
+    Geocoder = make_mock_geocoder(google.Geocoder, REQUEST_DURATION)
+    series = pd.Series([addresses[0], addresses[1], addresses[0], None], index=[10, 11, 12, 13])
+
+    with GeocoderClient(rate_limit=RATE_LIMIT, Geocoder=Geocoder) as client:
+        frame = dataframes.geocode_frame(series, client)
+    assert mock_geocoders.REQUEST_COUNTS[google.Geocoder.url] == 2
+    partition = next(dataframes.partition_geocoder('address', Geocoder=Geocoder)(iter([series.to_frame('address')])))
+
+    assert list(frame.columns) == dataframes.COLUMNS
+    assert list(frame.index) == [10, 11, 12, 13]
+    assert frame.loc[10, 'lat'] == frame.loc[12, 'lat'] != 0
+    assert pd.isna(frame.loc[13, 'lat']) and pd.isna(frame.loc[13, 'match_level'])
+    assert list(partition.columns) == ['address'] + dataframes.COLUMNS
+
+
+def test_warmup_connects_and_fetches_token_up_front(monkeypatch):
+    monkeypatch.setattr(mock_geocoders, 'REQUEST_COUNTS', Counter())
+    Geocoder = make_mock_geocoder(robust.Geocoder, REQUEST_DURATION)
+
+    with GeocoderClient(rate_limit=RATE_LIMIT, Geocoder=Geocoder) as client:
+        report = client.warmup(connections=3)
+        assert mock_geocoders.REQUEST_COUNTS['https://maps.googleapis.com/'] == 3
+        assert mock_geocoders.REQUEST_COUNTS['https://geocode.arcgis.com/'] == 3
+        assert mock_geocoders.REQUEST_COUNTS[esri.Geocoder.token_url] == 1
+        client.geocode_many(TEST_ADDRESSES)
+
+    assert mock_geocoders.REQUEST_COUNTS[esri.Geocoder.token_url] == 1
+    assert report.connections == 6 and report.seconds >= 0
+    assert len(report.providers) == len(Geocoder.Providers)
+
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder, warmup_connections=1)
+    assert len(list(streamer.geocode_gen(TEST_ADDRESSES))) == len(TEST_ADDRESSES)
+    assert streamer.warmup_report.connections == 2
+
+
+def test_streamer_warmup_doesnt_delay_the_first_result():
+    class Geocoder(make_mock_geocoder(google.Geocoder, REQUEST_DURATION)):
+        async def warmup(self, client, connections=2):
+            await asyncio.sleep(0.5)
+            return await super().warmup(client, connections)
+
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder, warmup_connections=1)
+    started = time.perf_counter()
+    results = streamer.geocode_gen(TEST_ADDRESSES)
+    next(results)
+    assert time.perf_counter() - started < 0.4
+    list(results)
+    assert streamer.warmup_report.connections == 1
+
+
+def test_profiling_attributes_time_to_stages(tmp_path):
+    Geocoder = make_mock_geocoder(robust.Geocoder, REQUEST_DURATION)
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder)
+
+    assert profiling.span('network') is profiling.span('parse')  # no-op while disabled
+    with profiling.profile() as profiler:
+        list(streamer.geocode_gen(TEST_ADDRESSES))
+    list(streamer.geocode_gen(TEST_ADDRESSES))  # not recorded
+
+    breakdown = profiler.breakdown()
+    assert {'queue_wait', 'geocode', 'google', 'semaphore_wait', 'network', 'parse'} <= set(breakdown)
+    assert breakdown['geocode'].count == len(TEST_ADDRESSES)
+    assert set(profiler.addresses) == set(TEST_ADDRESSES)
+    assert 'geocode;google;network ' in profiler.folded()
+    assert 'semaphore_wait' in profiler.report()
+
+
+def test_result_cache_build_lookup_and_compact(tmp_path):
+    Geocoder = make_mock_geocoder(google.Geocoder, REQUEST_DURATION)
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder)
+    results = list(streamer.geocode_gen(addresses[:20]))
+    unique = len({normalize_address(a) for a in addresses[:20]})
+    path = str(tmp_path / 'results.rgrc')
+
+    # Failed results aren't cached.
+    assert result_cache.build_cache(results + [GeocodedLocation.null_island(addresses[25])], path) == unique
+    cache = result_cache.ResultCache(path)
+    assert cache.get(addresses[3]) == results[3]
+    assert cache.get(addresses[3].lower()).lat == results[3].lat
+    assert addresses[25] not in cache and cache.get(addresses[30]) is None
+    cache.close()
+
+    moved = GeocodedLocation(addresses[0], -32.0, 116.0, 'Moved', 0.6, MATCH_LEVEL.STREET)
+    extra = GeocodedLocation(addresses[30], -31.5, 115.5, 'Mocked Geocoded Address in Google Response', 1.0, MATCH_LEVEL.ROOFTOP)
+    assert result_cache.compact_cache([path], [moved, extra], path) == unique + 1
+    cache = result_cache.ResultCache(path)
+    assert cache.get(addresses[0]) == moved
+    assert cache.get(addresses[30]) == extra
+    cache.close()
+    assert os.listdir(tmp_path) == ['results.rgrc']
+
+
+def test_cached_geocoder_skips_requests_for_cached_addresses(tmp_path, monkeypatch):
+    path = str(tmp_path / 'results.rgrc')
+    result_cache.build_cache([GeocodedLocation(addresses[0], -31.7, 115.7, 'Cached', 1.0, MATCH_LEVEL.ROOFTOP)], path)
+    monkeypatch.setattr(mock_geocoders, 'REQUEST_COUNTS', Counter())
+    Geocoder = result_cache.make_cached_geocoder(path, make_mock_geocoder(google.Geocoder, REQUEST_DURATION))
+    streamer = GeocodeStreamerQueue(rate_limit=RATE_LIMIT, Geocoder=Geocoder)
+
+    results = list(streamer.geocode_gen(addresses[:3]))
+    assert results[0].geocode_address == 'Cached'
+    assert mock_geocoders.REQUEST_COUNTS[google.Geocoder.url] == 2
+
+    # Geocoders pick up a compacted cache once they next check the file,
+    # and the replaced one is closed.
+    monkeypatch.setattr(result_cache.SETTINGS, 'reopen_interval', 0)
+    monkeypatch.setattr(result_cache.SETTINGS, 'close_replaced_after', 0)
+    replaced = result_cache.open_cache(path)
+    result_cache.compact_cache([path], [GeocodedLocation(addresses[1], -31.6, 115.6, 'Compacted', 1.0, MATCH_LEVEL.ROOFTOP)], path)
+    results = list(streamer.geocode_gen(addresses[:3]))
+    assert [r.geocode_address for r in results[:2]] == ['Cached', 'Compacted']
+    assert mock_geocoders.REQUEST_COUNTS[google.Geocoder.url] == 3
+    assert replaced.mm.closed